@@ -0,0 +1,61 @@
+# Micro-benchmark: memory per IntegrationItem and encode time of the dedicated
+# encoder versus FastAPI's jsonable_encoder.
+#
+#   cd backend && python -m benchmarks.bench_integration_item [count]
+
+import json
+import sys
+import time
+import tracemalloc
+
+from fastapi.encoders import jsonable_encoder
+
+from integrations.integration_item import IntegrationItem, encode_integration_items
+
+class DictIntegrationItem:
+    # The previous, __dict__-backed layout, kept here only for comparison
+    def __init__(self, **kwargs):
+        for name in IntegrationItem.__slots__:
+            setattr(self, name, kwargs.get(name))
+
+def _item_kwargs(index):
+    return {
+        'id': f'rec{index:08d}',
+        'type': 'record',
+        'name': f'Record {index}',
+        'parent_id': 'tbl0001',
+        'creation_time': '2024-01-01T00:00:00.000Z',
+        'url': f'https://airtable.com/tbl0001/rec{index:08d}',
+        'properties': {'fields': {'Name': f'Record {index}', 'Status': 'Done'}},
+    }
+
+def _measure_memory(item_class, count):
+    kwargs = [_item_kwargs(index) for index in range(count)]
+    tracemalloc.start()
+    items = [item_class(**item_kwargs) for item_kwargs in kwargs]
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return items, size / count
+
+def _measure_time(function, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def main(count=200_000):
+    dict_items, dict_bytes = _measure_memory(DictIntegrationItem, count)
+    slotted_items, slotted_bytes = _measure_memory(IntegrationItem, count)
+
+    generic_seconds = _measure_time(lambda: json.dumps(jsonable_encoder(dict_items)).encode('utf-8'))
+    fast_seconds = _measure_time(lambda: encode_integration_items(slotted_items))
+
+    print(f'items: {count}')
+    print(f'memory per item: __dict__ {dict_bytes:.0f} B, __slots__ {slotted_bytes:.0f} B ({dict_bytes / slotted_bytes:.2f}x)')
+    print(f'encode: jsonable_encoder {generic_seconds:.3f} s, encode_integration_items {fast_seconds:.3f} s ({generic_seconds / fast_seconds:.1f}x)')
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200_000)
@@ -0,0 +1,180 @@
+# End-to-end load benchmark: runs the real get_items_airtable, get_items_notion
+# and get_items_hubspot against local fake provider servers with an in-process
+# Redis stand-in, and reports throughput, upstream calls, latency and peak RSS.
+#
+#   cd backend && python -m benchmarks.bench_load --objects 20000 --latency-ms 30 --rate-429 0.01
+#
+# Each provider runs in its own process so peak RSS is not shared between them.
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import resource
+import socket
+import statistics
+import sys
+import time
+from dataclasses import asdict, fields
+
+import httpx
+
+from benchmarks.fake_providers import FakeProviderConfig, serve
+
+PROVIDERS = ('airtable', 'notion', 'hubspot')
+
+BENCH_CREDENTIALS = {
+    'airtable': {'pat': 'bench-pat', 'base_id': 'appBENCH'},
+    'notion': {'integration_token': 'bench-token'},
+    'hubspot': {'access_token': 'bench-token'},
+}
+
+class LocalRedirectTransport(httpx.AsyncBaseTransport):
+    # Sends every request to the fake server and records time to response headers
+    def __init__(self, port: int, latencies: list):
+        self._port = port
+        self._latencies = latencies
+        self._transport = httpx.AsyncHTTPTransport(limits=httpx.Limits(max_connections=100, max_keepalive_connections=100))
+
+    async def handle_async_request(self, request):
+        request.url = request.url.copy_with(scheme='http', host='127.0.0.1', port=self._port)
+        started_at = time.perf_counter()
+        response = await self._transport.handle_async_request(request)
+        self._latencies.append(time.perf_counter() - started_at)
+        return response
+
+    async def aclose(self):
+        await self._transport.aclose()
+
+def _percentile(values, percent):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(percent / 100 * (len(ordered) - 1))))]
+
+def _get_items(provider: str):
+    if provider == 'airtable':
+        from integrations.airtable import get_items_airtable
+        return get_items_airtable
+    if provider == 'notion':
+        from integrations.notion import get_items_notion
+        return get_items_notion
+    from integrations.hubspot import get_items_hubspot
+    return get_items_hubspot
+
+async def _bench(provider: str, port: int, repeat: int, real_rate_limits: bool):
+    import http_clients
+    import rate_limiter
+    import redis_client
+    from benchmarks.fake_redis import FakeRedis
+
+    redis_client.redis_client = FakeRedis()
+    if not real_rate_limits:
+        # Measure the crawler, not the provider budget; the limiter itself still runs
+        rate_limiter.PROVIDER_RATE_LIMITS.update({name: (1_000_000, 1.0) for name in rate_limiter.PROVIDER_RATE_LIMITS})
+
+    latencies = []
+    http_clients.register_http_client(provider, httpx.AsyncClient(transport=LocalRedirectTransport(port, latencies), timeout=60))
+    get_items = _get_items(provider)
+    credentials = json.dumps(BENCH_CREDENTIALS[provider])
+
+    runs = []
+    async with httpx.AsyncClient(base_url=f'http://127.0.0.1:{port}') as control:
+        for _ in range(repeat):
+            await control.post('/__reset')
+            latencies.clear()
+            started_at = time.perf_counter()
+            item_count = 0
+            async for _ in get_items(credentials):
+                item_count += 1
+            seconds = time.perf_counter() - started_at
+            calls = (await control.get('/__stats')).json()['calls']
+            runs.append({
+                'items': item_count,
+                'seconds': seconds,
+                'upstream_calls': sum(count for kind, count in calls.items() if kind != '429'),
+                'rate_limited': calls.get('429', 0),
+                'p50_ms': _percentile(latencies, 50) * 1000,
+                'p99_ms': _percentile(latencies, 99) * 1000,
+            })
+    await http_clients.close_http_clients()
+
+    best = min(runs, key=lambda run: run['seconds'])
+    return {
+        'provider': provider,
+        'items': best['items'],
+        'items_per_sec': best['items'] / best['seconds'] if best['seconds'] else 0.0,
+        'seconds_median': statistics.median(run['seconds'] for run in runs),
+        'upstream_calls': best['upstream_calls'],
+        'rate_limited': best['rate_limited'],
+        'p50_ms': best['p50_ms'],
+        'p99_ms': best['p99_ms'],
+        # ru_maxrss is in KiB on Linux
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+def _bench_process(provider: str, port: int, repeat: int, real_rate_limits: bool, results):
+    results.put(asyncio.run(_bench(provider, port, repeat, real_rate_limits)))
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def _wait_for_server(port: int, timeout: float = 10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            httpx.get(f'http://127.0.0.1:{port}/__stats', timeout=1)
+            return
+        except httpx.TransportError:
+            time.sleep(0.05)
+    raise RuntimeError('Fake provider server did not start')
+
+def run_benchmarks(config: FakeProviderConfig, providers=PROVIDERS, repeat: int = 3, real_rate_limits: bool = False):
+    context = multiprocessing.get_context('spawn')
+    port = _free_port()
+    server = context.Process(target=serve, args=(config, port), daemon=True)
+    server.start()
+    try:
+        _wait_for_server(port)
+        reports = []
+        for provider in providers:
+            results = context.Queue()
+            worker = context.Process(target=_bench_process, args=(provider, port, repeat, real_rate_limits, results))
+            worker.start()
+            reports.append(results.get())
+            worker.join()
+        return reports
+    finally:
+        server.terminate()
+        server.join()
+
+def _print_reports(reports):
+    columns = ('provider', 'items', 'items_per_sec', 'seconds_median', 'upstream_calls', 'rate_limited', 'p50_ms', 'p99_ms', 'peak_rss_mb')
+    print(' '.join(f'{column:>15}' for column in columns))
+    for report in reports:
+        print(' '.join(
+            f'{report[column]:>15.1f}' if isinstance(report[column], float) else f'{report[column]:>15}'
+            for column in columns
+        ))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the provider loaders against local fake APIs.')
+    for field in fields(FakeProviderConfig):
+        parser.add_argument(f'--{field.name.replace("_", "-")}', type=type(field.default), default=field.default)
+    parser.add_argument('--providers', nargs='+', choices=PROVIDERS, default=list(PROVIDERS))
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--real-rate-limits', action='store_true', help='keep the production per-provider budgets')
+    parser.add_argument('--json', dest='json_path', help='also write the reports to this file')
+    args = parser.parse_args(argv)
+
+    config = FakeProviderConfig(**{field.name: getattr(args, field.name) for field in fields(FakeProviderConfig)})
+    reports = run_benchmarks(config, args.providers, args.repeat, args.real_rate_limits)
+    _print_reports(reports)
+    if args.json_path:
+        with open(args.json_path, 'w') as output:
+            json.dump({'config': asdict(config), 'reports': reports}, output, indent=2)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,207 @@
+# Local stand-ins for the Airtable, Notion and HubSpot APIs used by the
+# benchmark harness. One Starlette app answers for all three providers; the
+# harness rewrites upstream URLs to it, so the integrations run unmodified.
+
+import asyncio
+import random
+from collections import Counter
+from dataclasses import asdict, dataclass
+
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+@dataclass
+class FakeProviderConfig:
+    objects: int = 10_000         # records/pages/objects per provider
+    containers: int = 10          # Airtable tables / Notion databases the objects are spread over
+    page_size: int = 100          # upstream page size (all three APIs cap it at 100)
+    latency_ms: float = 20.0      # base latency added to every response
+    jitter_ms: float = 10.0       # +/- uniform jitter around the base latency
+    rate_429: float = 0.0         # fraction of requests answered with 429
+    retry_after: float = 0.05     # Retry-After seconds sent with injected 429s
+    seed: int = 1
+
+TIMESTAMP = '2024-01-01T00:00:00.000Z'
+HUBSPOT_PROPERTY_NAMES = {
+    'contacts': ('firstname', 'lastname', 'email', 'createdate', 'hs_lastmodifieddate'),
+    'companies': ('name', 'domain', 'createdate', 'hs_lastmodifieddate'),
+}
+
+def _container_sizes(config: FakeProviderConfig):
+    base, extra = divmod(config.objects, config.containers)
+    return [base + (1 if index < extra else 0) for index in range(config.containers)]
+
+def _page(items_count: int, start: int, page_size: int):
+    end = min(items_count, start + page_size)
+    return range(start, end), (str(end) if end < items_count else None)
+
+def create_app(config: FakeProviderConfig):
+    rng = random.Random(config.seed)
+    calls = Counter()
+    sizes = _container_sizes(config)
+
+    async def simulate(request: Request, kind: str):
+        # Returns a 429 response when one is injected, otherwise None
+        calls[kind] += 1
+        delay = config.latency_ms + rng.uniform(-config.jitter_ms, config.jitter_ms)
+        await asyncio.sleep(max(0.0, delay) / 1000)
+        if config.rate_429 and rng.random() < config.rate_429:
+            calls['429'] += 1
+            return JSONResponse({'error': 'rate limited'}, status_code=429, headers={'Retry-After': str(config.retry_after)})
+        return None
+
+    # HubSpot
+    def hubspot_properties(object_type: str, object_id: int):
+        return {
+            'firstname': f'First {object_id}',
+            'lastname': f'Last {object_id}',
+            'email': f'user{object_id}@example.com',
+            'name': f'{object_type} {object_id}',
+            'domain': f'company{object_id}.example.com',
+            'createdate': TIMESTAMP,
+            'hs_lastmodifieddate': TIMESTAMP,
+        }
+
+    async def hubspot_list(request: Request):
+        limited = await simulate(request, 'hubspot_list')
+        if limited:
+            return limited
+        object_type = request.path_params['object_type']
+        requested = [name for name in request.query_params.get('properties', '').split(',') if name]
+        limit = min(int(request.query_params.get('limit', 10)), config.page_size)
+        ids, after = _page(config.objects, int(request.query_params.get('after') or 0), limit)
+        body = {'results': [
+            {
+                'id': str(object_id),
+                'properties': {name: value for name, value in hubspot_properties(object_type, object_id).items() if name in requested},
+                'createdAt': TIMESTAMP,
+                'updatedAt': TIMESTAMP,
+                'archived': False,
+            }
+            for object_id in ids
+        ]}
+        if after:
+            body['paging'] = {'next': {'after': after}}
+        return JSONResponse(body)
+
+    async def hubspot_property_list(request: Request):
+        limited = await simulate(request, 'hubspot_properties')
+        if limited:
+            return limited
+        names = HUBSPOT_PROPERTY_NAMES.get(request.path_params['object_type'], ())
+        return JSONResponse({'results': [{'name': name, 'type': 'string'} for name in names]})
+
+    # Airtable
+    async def airtable_tables(request: Request):
+        limited = await simulate(request, 'airtable_tables')
+        if limited:
+            return limited
+        return JSONResponse({'tables': [
+            {'id': f'tbl{index:05d}', 'name': f'Table {index}', 'primaryFieldId': 'fldName', 'fields': [
+                {'id': 'fldName', 'name': 'Name', 'type': 'singleLineText'},
+                {'id': 'fldNotes', 'name': 'Notes', 'type': 'multilineText'},
+            ]}
+            for index in range(config.containers)
+        ]})
+
+    async def airtable_records(request: Request):
+        limited = await simulate(request, 'airtable_records')
+        if limited:
+            return limited
+        table_id = request.path_params['table_id']
+        table_index = int(table_id[3:])
+        page_size = min(int(request.query_params.get('pageSize', 100)), config.page_size)
+        ids, offset = _page(sizes[table_index], int(request.query_params.get('offset') or 0), page_size)
+        body = {'records': [
+            {'id': f'rec{table_index:05d}{record_id:08d}', 'createdTime': TIMESTAMP, 'fields': {'Name': f'Record {record_id}', 'Notes': 'Lorem ipsum dolor sit amet'}}
+            for record_id in ids
+        ]}
+        if offset:
+            body['offset'] = offset
+        return JSONResponse(body)
+
+    # Notion
+    def notion_database(index: int):
+        return {
+            'object': 'database',
+            'id': f'db-{index:05d}',
+            'title': [{'type': 'text', 'plain_text': f'Database {index}', 'text': {'content': f'Database {index}'}}],
+            'parent': {'type': 'workspace', 'workspace': True},
+            'created_time': TIMESTAMP,
+            'last_edited_time': TIMESTAMP,
+            'url': f'https://www.notion.so/db{index:05d}',
+            'properties': {
+                'Name': {'id': 'title', 'name': 'Name', 'type': 'title', 'title': {}},
+                'Notes': {'id': 'nts', 'name': 'Notes', 'type': 'rich_text', 'rich_text': {}},
+                'Due': {'id': 'due', 'name': 'Due', 'type': 'date', 'date': {}},
+            },
+        }
+
+    async def notion_search(request: Request):
+        limited = await simulate(request, 'notion_search')
+        if limited:
+            return limited
+        body = await request.json()
+        ids, next_cursor = _page(config.containers, int(body.get('start_cursor') or 0), min(body.get('page_size', 100), config.page_size))
+        return JSONResponse({'object': 'list', 'results': [notion_database(index) for index in ids], 'has_more': next_cursor is not None, 'next_cursor': next_cursor})
+
+    async def notion_retrieve_database(request: Request):
+        limited = await simulate(request, 'notion_database')
+        if limited:
+            return limited
+        database_id = request.path_params['database_id']
+        index = database_id[len('db-'):]
+        if not database_id.startswith('db-') or not index.isdigit() or int(index) >= config.containers:
+            return JSONResponse({'object': 'error', 'status': 404, 'code': 'object_not_found'}, status_code=404)
+        return JSONResponse(notion_database(int(index)))
+
+    async def notion_query(request: Request):
+        limited = await simulate(request, 'notion_query')
+        if limited:
+            return limited
+        database_id = request.path_params['database_id']
+        database_index = int(database_id[3:])
+        body = await request.json()
+        ids, next_cursor = _page(sizes[database_index], int(body.get('start_cursor') or 0), min(body.get('page_size', 100), config.page_size))
+        return JSONResponse({'object': 'list', 'results': [
+            {
+                'object': 'page',
+                'id': f'{database_id}-{page_id:08d}',
+                'created_time': TIMESTAMP,
+                'last_edited_time': TIMESTAMP,
+                'parent': {'type': 'database_id', 'database_id': database_id},
+                'url': f'https://www.notion.so/{database_id}{page_id:08d}',
+                'properties': {
+                    'Name': {'id': 'title', 'type': 'title', 'title': [{'type': 'text', 'plain_text': f'Page {page_id}', 'text': {'content': f'Page {page_id}'}}]},
+                    'Notes': {'id': 'nts', 'type': 'rich_text', 'rich_text': [{'type': 'text', 'plain_text': 'Lorem ipsum', 'text': {'content': 'Lorem ipsum'}}]},
+                    'Due': {'id': 'due', 'type': 'date', 'date': {'start': '2024-02-01'}},
+                },
+            }
+            for page_id in ids
+        ], 'has_more': next_cursor is not None, 'next_cursor': next_cursor})
+
+    # Harness bookkeeping
+    async def stats(request: Request):
+        return JSONResponse({'calls': dict(calls), 'config': asdict(config)})
+
+    async def reset(request: Request):
+        calls.clear()
+        return JSONResponse({'calls': {}})
+
+    return Starlette(routes=[
+        Route('/crm/v3/objects/{object_type}', hubspot_list, methods=['GET']),
+        Route('/crm/v3/properties/{object_type}', hubspot_property_list, methods=['GET']),
+        Route('/v0/meta/bases/{base_id}/tables', airtable_tables, methods=['GET']),
+        Route('/v0/{base_id}/{table_id}', airtable_records, methods=['GET']),
+        Route('/v1/search', notion_search, methods=['POST']),
+        Route('/v1/databases/{database_id}', notion_retrieve_database, methods=['GET']),
+        Route('/v1/databases/{database_id}/query', notion_query, methods=['POST']),
+        Route('/__stats', stats, methods=['GET']),
+        Route('/__reset', reset, methods=['POST']),
+    ])
+
+def serve(config: FakeProviderConfig, port: int):
+    import uvicorn
+    uvicorn.run(create_app(config), host='127.0.0.1', port=port, log_level='warning', access_log=False)
@@ -0,0 +1,138 @@
+# In-process stand-in for the subset of redis.asyncio.Redis that the backend
+# uses, so benchmarks need no Redis server. Lua scripts are not interpreted;
+# the known ones are re-implemented in Python.
+
+import time
+
+import rate_limiter
+import redis_client
+
+class FakeRedis:
+    def __init__(self):
+        self._data = {}
+        self._expires = {}
+
+    def _alive(self, key):
+        expires_at = self._expires.get(key)
+        if expires_at is not None and expires_at <= time.monotonic():
+            self._data.pop(key, None)
+            self._expires.pop(key, None)
+        return key in self._data
+
+    def _expire_in(self, key, seconds):
+        if seconds:
+            self._expires[key] = time.monotonic() + seconds
+        else:
+            self._expires.pop(key, None)
+
+    async def get(self, key):
+        return self._data.get(key) if self._alive(key) else None
+
+    async def set(self, key, value, ex=None, px=None, nx=False):
+        if nx and self._alive(key):
+            return None
+        self._data[key] = str(value)
+        self._expire_in(key, ex or (px / 1000 if px else None))
+        return True
+
+    async def mget(self, keys):
+        return [await self.get(key) for key in keys]
+
+    async def delete(self, *keys):
+        removed = 0
+        for key in keys:
+            removed += int(self._alive(key))
+            self._data.pop(key, None)
+            self._expires.pop(key, None)
+        return removed
+
+    async def expire(self, key, seconds):
+        if not self._alive(key):
+            return False
+        self._expire_in(key, seconds)
+        return True
+
+    async def hgetall(self, key):
+        return dict(self._data.get(key, {})) if self._alive(key) else {}
+
+    async def hset(self, key, mapping):
+        if not self._alive(key):
+            self._data[key] = {}
+        self._data[key].update({field: str(value) for field, value in mapping.items()})
+        return len(mapping)
+
+    async def publish(self, channel, message):
+        return 0
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def register_script(self, script):
+        handlers = {
+            rate_limiter.TOKEN_BUCKET_SCRIPT: self._token_bucket,
+            rate_limiter.BLOCK_SCRIPT: self._block,
+            redis_client.DELETE_IF_VALUE_SCRIPT: self._delete_if_value,
+        }
+        if script not in handlers:
+            raise NotImplementedError('FakeRedis cannot run this script')
+        handler = handlers[script]
+
+        async def run(keys=(), args=()):
+            return handler(list(keys), list(args))
+        return run
+
+    def _token_bucket(self, keys, args):
+        bucket_key, block_key = keys
+        if self._alive(block_key):
+            return max(1, int((self._expires[block_key] - time.monotonic()) * 1000))
+        capacity, refill_per_ms = float(args[0]), float(args[1])
+        now = time.monotonic() * 1000
+        tokens, ts = self._data.get(bucket_key, (capacity, now))
+        tokens = min(capacity, tokens + max(0.0, now - ts) * refill_per_ms)
+        wait = 0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            wait = int((1 - tokens) / refill_per_ms) + 1
+        self._data[bucket_key] = (tokens, now)
+        return wait
+
+    def _block(self, keys, args):
+        block_key = keys[0]
+        milliseconds = int(args[0])
+        remaining = (self._expires[block_key] - time.monotonic()) * 1000 if self._alive(block_key) else 0
+        if remaining < milliseconds:
+            self._data[block_key] = '1'
+            self._expire_in(block_key, milliseconds / 1000)
+        return 1
+
+    def _delete_if_value(self, keys, args):
+        key = keys[0]
+        if self._alive(key) and self._data[key] == str(args[0]):
+            self._data.pop(key, None)
+            self._expires.pop(key, None)
+            return 1
+        return 0
+
+class FakePipeline:
+    def __init__(self, redis):
+        self._redis = redis
+        self._commands = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self._commands = []
+
+    def __getattr__(self, name):
+        method = getattr(self._redis, name)
+
+        def queue(*args, **kwargs):
+            self._commands.append((method, args, kwargs))
+            return self
+        return queue
+
+    async def execute(self):
+        commands, self._commands = self._commands, []
+        return [await method(*args, **kwargs) for method, args, kwargs in commands]
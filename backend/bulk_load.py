@@ -0,0 +1,122 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import List
+
+from fastapi import HTTPException
+from pydantic import BaseModel
+
+from redis_client import get_values_redis
+
+# Crawl steps in flight across all tenants of one bulk load
+BULK_LOAD_MAX_CONCURRENCY = int(os.environ.get('BULK_LOAD_MAX_CONCURRENCY', 16))
+
+class BulkLoadTenant(BaseModel):
+    org_id: str
+    user_id: str
+    provider: str
+
+class BulkLoadRequest(BaseModel):
+    tenants: List[BulkLoadTenant]
+    incremental: bool = False
+    include_items: bool = False
+
+class FairScheduler:
+    # Hands out a fixed number of slots round-robin across the tenants waiting for
+    # one, so a tenant with a huge crawl gets one turn per rotation like everyone else
+    def __init__(self, max_concurrency: int):
+        self._available = max_concurrency
+        self._waiters = OrderedDict()
+
+    @asynccontextmanager
+    async def slot(self, tenant):
+        await self._acquire(tenant)
+        try:
+            yield
+        finally:
+            self._release()
+
+    async def _acquire(self, tenant):
+        if self._available > 0 and not self._waiters:
+            self._available -= 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(tenant, deque()).append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was granted just as we were cancelled; pass it on
+                self._release()
+            else:
+                self._remove_waiter(tenant, waiter)
+            raise
+
+    def _remove_waiter(self, tenant, waiter):
+        waiters = self._waiters.get(tenant)
+        if waiters and waiter in waiters:
+            waiters.remove(waiter)
+            if not waiters:
+                del self._waiters[tenant]
+
+    def _release(self):
+        while self._waiters:
+            tenant, waiters = next(iter(self._waiters.items()))
+            waiter = waiters.popleft()
+            if waiters:
+                self._waiters.move_to_end(tenant)
+            else:
+                del self._waiters[tenant]
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self._available += 1
+
+async def _iter_scheduled(scheduler: FairScheduler, tenant, items):
+    # Every step of the tenant's crawl (an upstream page or a buffered item) needs a slot
+    while True:
+        async with scheduler.slot(tenant):
+            try:
+                item = await items.__anext__()
+            except StopAsyncIteration:
+                return
+        yield item
+
+async def _load_tenant(scheduler: FairScheduler, tenant: BulkLoadTenant, credentials, items_factory, include_items: bool):
+    result = {
+        'org_id': tenant.org_id,
+        'user_id': tenant.user_id,
+        'provider': tenant.provider,
+    }
+    started_at = time.perf_counter()
+    try:
+        if not credentials:
+            raise HTTPException(status_code=404, detail='No credentials found for this user/org')
+        tenant_key = (tenant.org_id, tenant.user_id, tenant.provider)
+        items = [item async for item in _iter_scheduled(scheduler, tenant_key, items_factory(tenant.provider, credentials))]
+        result.update(status='completed', item_count=len(items))
+        if include_items:
+            result['items'] = [item.to_dict() for item in items]
+    except Exception as e:
+        result.update(status='failed', error=e.detail if isinstance(e, HTTPException) else str(e))
+    result['seconds'] = round(time.perf_counter() - started_at, 3)
+    return result
+
+async def run_bulk_load(tenants: List[BulkLoadTenant], items_factory, include_items: bool = False, max_concurrency: int = BULK_LOAD_MAX_CONCURRENCY):
+    # `items_factory(provider, credentials)` returns the item iterator for one tenant.
+    # Stored credentials for every tenant are resolved with a single MGET.
+    started_at = time.perf_counter()
+    credentials = await get_values_redis([
+        f'{tenant.provider}_credentials:{tenant.org_id}:{tenant.user_id}' for tenant in tenants
+    ])
+    scheduler = FairScheduler(max_concurrency)
+    results = await asyncio.gather(*(
+        _load_tenant(scheduler, tenant, tenant_credentials, items_factory, include_items)
+        for tenant, tenant_credentials in zip(tenants, credentials)
+    ))
+    return {
+        'results': results,
+        'seconds': round(time.perf_counter() - started_at, 3),
+    }
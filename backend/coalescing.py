@@ -0,0 +1,67 @@
+import asyncio
+import json
+import logging
+import os
+import uuid
+
+from integrations.integration_item import IntegrationItem, encode_integration_items
+from item_cache import credential_fingerprint
+from redis_client import add_key_value_if_absent_redis, add_key_value_redis, delete_key_if_value_redis, get_value_redis
+
+logger = logging.getLogger(__name__)
+
+# Upper bound on one crawl; a lease older than this is assumed abandoned
+COALESCE_LEASE_TTL = int(os.environ.get('COALESCE_LEASE_TTL', 300))
+# How long a finished crawl's items stay available to followers in other workers
+COALESCE_RESULT_TTL = int(os.environ.get('COALESCE_RESULT_TTL', 30))
+COALESCE_POLL_INTERVAL = float(os.environ.get('COALESCE_POLL_INTERVAL', 0.2))
+
+_inflight = {}
+
+async def _follow(lease_key: str, lease_id: str, loader):
+    # Another worker leads this crawl: wait for its result, or crawl ourselves if
+    # its lease goes away without one (the leader failed or died)
+    result_key = f'{lease_key}:result:{lease_id}'
+    while True:
+        await asyncio.sleep(COALESCE_POLL_INTERVAL)
+        result = await get_value_redis(result_key)
+        if result:
+            return [IntegrationItem.from_dict(item) for item in json.loads(result)]
+        if await get_value_redis(lease_key) != lease_id:
+            logger.info('Coalesced load %s lost its leader, crawling directly', lease_key)
+            return [item async for item in loader()]
+
+async def _load_once(provider: str, fingerprint: str, loader):
+    lease_key = f'load_lease:{provider}:{fingerprint}'
+    lease_id = uuid.uuid4().hex
+    # The lease may lapse between a failed SET NX and the read of its holder; try again then
+    while not await add_key_value_if_absent_redis(lease_key, lease_id, expire=COALESCE_LEASE_TTL):
+        leader_id = await get_value_redis(lease_key)
+        if leader_id:
+            return await _follow(lease_key, leader_id, loader)
+    try:
+        items = [item async for item in loader()]
+        await add_key_value_redis(f'{lease_key}:result:{lease_id}', encode_integration_items(items).decode('utf-8'), expire=COALESCE_RESULT_TTL)
+        return items
+    finally:
+        # A crawl that outlived its lease must not release another worker's
+        await delete_key_if_value_redis(lease_key, lease_id)
+
+async def coalesced_items(provider: str, credentials, loader, scope=None):
+    # Concurrent loads with the same provider and credential fingerprint share one
+    # crawl: in-process by awaiting the same task, across workers through a short
+    # Redis lease whose holder publishes the result for everyone waiting on it
+    fingerprint = credential_fingerprint(credentials, scope)
+    inflight_key = (provider, fingerprint)
+    task = _inflight.get(inflight_key)
+    if task is None:
+        task = _inflight[inflight_key] = asyncio.create_task(_load_once(provider, fingerprint, loader))
+        task.add_done_callback(lambda _: _inflight.pop(inflight_key, None))
+    return await asyncio.shield(task)
+
+def coalesced_loader(provider: str, credentials, loader, scope=None):
+    # Wraps `loader` so that calling it joins the shared crawl
+    async def iter_items():
+        for item in await coalesced_items(provider, credentials, loader, scope):
+            yield item
+    return iter_items
@@ -0,0 +1,139 @@
+import json
+import os
+import time
+from collections import OrderedDict
+
+from fastapi import HTTPException
+
+from integrations.integration_item import IntegrationItem
+from item_cache import credential_fingerprint
+
+# Indexes kept per worker (one per provider, credential and scope) and how long
+# one is trusted before the next lookup rebuilds it from a fresh load
+HIERARCHY_INDEX_MAX_ENTRIES = int(os.environ.get('HIERARCHY_INDEX_MAX_ENTRIES', 16))
+HIERARCHY_INDEX_TTL = int(os.environ.get('HIERARCHY_INDEX_TTL', 300))
+
+class HierarchyIndex:
+    # id -> item and parent id -> child ids over one load, so trees can be walked
+    # without scanning the flat item list for every node
+    __slots__ = ('_items', '_shadowed', '_children', 'built_at')
+
+    def __init__(self):
+        self._items = {}
+        # Items whose id is already taken by an item of another type (HubSpot ids
+        # are only unique per object type), keyed by (type, id)
+        self._shadowed = {}
+        self._children = {}
+        self.built_at = time.time()
+
+    def __len__(self):
+        return len(self._items) + len(self._shadowed)
+
+    def add(self, item: IntegrationItem):
+        existing = self._items.get(item.id)
+        if existing is not None and existing.type != item.type:
+            self._shadowed[(item.type, item.id)] = item
+            return
+        if existing is None:
+            self._children.setdefault(item.parent_id, []).append(item.id)
+        self._items[item.id] = item
+
+    def get(self, item_id: str, item_type: str = None):
+        item = self._items.get(item_id)
+        if item is not None and item_type is not None and item.type != item_type:
+            return self._shadowed.get((item_type, item_id))
+        return item
+
+    def children(self, item_id: str):
+        return self._children.get(item_id, [])
+
+    def roots(self):
+        # Items without a parent, or whose parent is not part of this load
+        roots = [self._items[item_id] for item_id in self._children.get(None, ())]
+        for parent_id, child_ids in self._children.items():
+            if parent_id is not None and parent_id not in self._items:
+                roots.extend(self._items[item_id] for item_id in child_ids)
+        return roots + list(self._shadowed.values())
+
+    def path(self, item: IntegrationItem):
+        # Ancestors from the top of the tree down to `item` itself
+        path = [item]
+        seen = {item.id}
+        while path[0].parent_id is not None and path[0].parent_id not in seen:
+            parent = self._items.get(path[0].parent_id)
+            if parent is None:
+                break
+            seen.add(parent.id)
+            path.insert(0, parent)
+        return path
+
+    def subtree(self, roots: list, depth: int = None):
+        # Depth-first, parents before their children, so clients can render in order
+        stack = [(item, 0) for item in reversed(roots)]
+        seen = set()
+        while stack:
+            item, level = stack.pop()
+            if (item.type, item.id) in seen:
+                continue
+            seen.add((item.type, item.id))
+            yield item, level
+            if (depth is None or level < depth) and self._items.get(item.id) is item:
+                stack.extend((self._items[child_id], level + 1) for child_id in reversed(self.children(item.id)))
+
+    def node_dict(self, item: IntegrationItem):
+        node = item.to_dict()
+        if self._items.get(item.id) is item and item.id in self._children:
+            node['children'] = list(self._children[item.id])
+        return node
+
+_indexes = OrderedDict()
+
+def _index_key(provider: str, credentials, scope=None):
+    return provider, credential_fingerprint(credentials, scope)
+
+def _store_index(key, index: HierarchyIndex):
+    _indexes[key] = index
+    _indexes.move_to_end(key)
+    while len(_indexes) > HIERARCHY_INDEX_MAX_ENTRIES:
+        _indexes.popitem(last=False)
+
+async def get_hierarchy_index(provider: str, credentials, items_factory, scope=None):
+    # `items_factory` is a zero-argument callable returning the item iterator, used
+    # when this worker has no current index for the credential
+    key = _index_key(provider, credentials, scope)
+    index = _indexes.get(key)
+    if index is not None and time.time() - index.built_at <= HIERARCHY_INDEX_TTL:
+        _indexes.move_to_end(key)
+        return index
+
+    index = HierarchyIndex()
+    async for item in items_factory():
+        index.add(item)
+    if HIERARCHY_INDEX_MAX_ENTRIES > 0:
+        _store_index(key, index)
+    return index
+
+def node_payload(index: HierarchyIndex, item_id: str, item_type: str = None) -> bytes:
+    item = index.get(item_id, item_type)
+    if item is None:
+        raise HTTPException(status_code=404, detail=f'Item {item_id} not found.')
+    return json.dumps({
+        'item': index.node_dict(item),
+        'path': [{'id': ancestor.id, 'name': ancestor.name, 'type': ancestor.type} for ancestor in index.path(item)],
+    }, separators=(',', ':'), default=str).encode('utf-8')
+
+def subtree_payload(index: HierarchyIndex, root_id: str = None, depth: int = None) -> bytes:
+    # The subtree under `root_id` (or the whole forest) as a JSON list of nodes with a `depth` each
+    if root_id is None:
+        roots = index.roots()
+    else:
+        root = index.get(root_id)
+        if root is None:
+            raise HTTPException(status_code=404, detail=f'Item {root_id} not found.')
+        roots = [root]
+    nodes = []
+    for item, level in index.subtree(roots, depth):
+        node = index.node_dict(item)
+        node['depth'] = level
+        nodes.append(node)
+    return json.dumps(nodes, separators=(',', ':'), default=str).encode('utf-8')
@@ -0,0 +1,75 @@
+import os
+import httpx
+
+PROVIDERS = ('airtable', 'notion', 'hubspot')
+
+# Defaults for every provider pool; each value can be overridden globally
+# (e.g. HTTP_MAX_CONNECTIONS) or per provider (e.g. HUBSPOT_HTTP_MAX_CONNECTIONS)
+DEFAULT_HTTP_SETTINGS = {
+    'max_connections': 20,
+    'max_keepalive_connections': 10,
+    'keepalive_expiry': 30.0,
+    'connect_timeout': 5.0,
+    'timeout': 30.0,
+    'http2': False,
+}
+
+_clients = {}
+
+def _http2_available():
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+def provider_setting(provider: str, name: str, defaults: dict = DEFAULT_HTTP_SETTINGS, prefix: str = 'HTTP'):
+    # `defaults[name]`, overridden by {PREFIX}_{NAME} or {PROVIDER}_{PREFIX}_{NAME}
+    # and cast to the default's type
+    default = defaults[name]
+    value = os.environ.get(f'{provider.upper()}_{prefix}_{name.upper()}', os.environ.get(f'{prefix}_{name.upper()}'))
+    if value is None:
+        return default
+    if isinstance(default, bool):
+        return value.lower() in ('1', 'true', 'yes')
+    return type(default)(value)
+
+def get_http_settings(provider: str):
+    settings = {name: provider_setting(provider, name) for name in DEFAULT_HTTP_SETTINGS}
+    # HTTP/2 needs the optional `h2` package (pip install httpx[http2])
+    settings['http2'] = settings['http2'] and _http2_available()
+    return settings
+
+def create_http_client(provider: str):
+    settings = get_http_settings(provider)
+    return httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=settings['max_connections'],
+            max_keepalive_connections=settings['max_keepalive_connections'],
+            keepalive_expiry=settings['keepalive_expiry'],
+        ),
+        timeout=httpx.Timeout(settings['timeout'], connect=settings['connect_timeout']),
+        http2=settings['http2'],
+    )
+
+def init_http_clients():
+    for provider in PROVIDERS:
+        if provider not in _clients or _clients[provider].is_closed:
+            _clients[provider] = create_http_client(provider)
+
+async def close_http_clients():
+    while _clients:
+        _, client = _clients.popitem()
+        await client.aclose()
+
+def get_http_client(provider: str):
+    # Normally the pools are created by the app lifespan; scripts that call the
+    # integrations directly get a pool lazily on first use
+    client = _clients.get(provider)
+    if client is None or client.is_closed:
+        client = _clients[provider] = create_http_client(provider)
+    return client
+
+def register_http_client(provider: str, client):
+    # Replaces a provider's pool, e.g. with a client pointed at a local stand-in
+    _clients[provider] = client
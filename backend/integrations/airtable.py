@@ -1,20 +1,31 @@
 # airtable.py
 
+import base64
 import datetime
 import json
-import secrets
+import os
 from fastapi import Request, HTTPException
 from fastapi.responses import HTMLResponse
-import httpx
-import asyncio
-import base64
-import hashlib
+from functools import partial
 
-import requests
 from integrations.integration_item import IntegrationItem
 
+from metrics import parse_json, profiled
+from pagination import check_cursor
+from upstream import iter_pages_concurrently, upstream_client
 from redis_client import add_key_value_redis, get_value_redis, delete_key_redis
+from webhooks import check_webhook_signature, sign_webhook_payload
+
+PAT = os.environ.get('PAT', '')
+BASE_ID = os.environ.get('BASE_ID', '')
+
+AIRTABLE_API_URL = 'https://api.airtable.com/v0'
 
+# Airtable caps pageSize at 100 records
+AIRTABLE_PAGE_SIZE = 100
+
+# Number of tables queried at once; Airtable allows 5 requests per second per base
+AIRTABLE_MAX_CONCURRENCY = int(os.environ.get('AIRTABLE_MAX_CONCURRENCY', 5))
 
 
 async def authorize_airtable(user_id, org_id):
@@ -41,11 +52,12 @@ async def oauth2callback_airtable(request: Request):
     return HTMLResponse(content=close_window_script)
 
 async def get_airtable_credentials(user_id, org_id):
-    credentials = await get_value_redis(f'airtable_credentials:{org_id}:{user_id}')
+    credentials = await get_value_redis(f'airtable_credentials:{org_id}:{user_id}', use_local_cache=True)
     if not credentials:
         return None
     return json.loads(credentials)
 
+@profiled('item_construction')
 async def create_integration_item_metadata_object(response_json, item_type, parent_id=None, parent_name=None):
     if item_type == 'record':
         name = response_json.get('fields', {}).get('Name', '') or f"Record {response_json.get('id')}"
@@ -67,79 +79,314 @@ async def create_integration_item_metadata_object(response_json, item_type, pare
         id=response_json.get('id'),
         name=name,
         type=item_type,
+        directory=item_type != 'record',
         parent_id=parent_id,
-        parent_name=parent_name,
+        parent_path_or_name=parent_name,
         properties=properties
     )
 
-async def fetch_items(base_id: str, pat: str, aggregated_response: list, offset=None):
-    headers = {
+async def fetch_tables(client, base_id: str, headers: dict):
+    # Get tables from Airtable Meta API
+    tables_response = await client.get(f'{AIRTABLE_API_URL}/meta/bases/{base_id}/tables', headers=headers)
+    if tables_response.status_code != 200:
+        raise HTTPException(status_code=tables_response.status_code, detail='Failed to list Airtable tables')
+    return parse_json(tables_response).get('tables', [])
+
+AIRTABLE_FORMULA_OPERATORS = {
+    'eq': '=',
+    'neq': '!=',
+    'gt': '>',
+    'gte': '>=',
+    'lt': '<',
+    'lte': '<=',
+}
+
+def modified_since_formula(modified_since: datetime.datetime):
+    return f"IS_AFTER(LAST_MODIFIED_TIME(), '{modified_since.isoformat()}')"
+
+def _formula_value(value):
+    if isinstance(value, bool):
+        return 'TRUE()' if value else 'FALSE()'
+    if isinstance(value, (int, float)):
+        return repr(value)
+    return "'" + value.replace('\\', '\\\\').replace("'", "\\'") + "'"
+
+def filter_formula(filters=None, modified_since=None):
+    # Translates load filters into one filterByFormula expression; None when nothing is filtered
+    conditions = []
+    for condition in filters or ():
+        field = '{' + condition['field'] + '}'
+        if condition['op'] == 'contains':
+            conditions.append(f"FIND({_formula_value(str(condition['value']))}, {field} & '')")
+        else:
+            conditions.append(f"{field} {AIRTABLE_FORMULA_OPERATORS[condition['op']]} {_formula_value(condition['value'])}")
+    if modified_since:
+        conditions.append(modified_since_formula(modified_since))
+    if len(conditions) > 1:
+        return f"AND({', '.join(conditions)})"
+    return conditions[0] if conditions else None
+
+async def fetch_table_records_page(client, base_id: str, table: dict, headers: dict, offset=None, page_size: int = AIRTABLE_PAGE_SIZE, formula=None, fields=None):
+    # One page of a table's records and the `offset` of the next one (None at the end)
+    table_id = table.get('id')
+    table_name = table.get('name')
+    params = {'pageSize': page_size}
+    if offset:
+        params['offset'] = offset
+    if fields:
+        params['fields[]'] = fields
+    if formula:
+        params['filterByFormula'] = formula
+    response = await client.get(
+        f'{AIRTABLE_API_URL}/{base_id}/{table_id}',
+        headers=headers,
+        params=params
+    )
+    if response.status_code != 200:
+        raise HTTPException(status_code=response.status_code, detail=f'Failed to list records for table {table_name}')
+
+    response_json = parse_json(response)
+    records = response_json.get('records', [])
+    for record in records:
+        # Add table information to each record
+        record['table_name'] = table_name
+        record['table_id'] = table_id
+    return records, response_json.get('offset')
+
+def _table_field_names(table: dict):
+    return {field.get('name') for field in table.get('fields', ())}
+
+def _can_match(table: dict, filters=None):
+    # Records of a table without a filtered field can never match, and Airtable
+    # rejects a formula naming an unknown field with a 422
+    field_names = _table_field_names(table)
+    return all(condition['field'] in field_names for condition in filters or ())
+
+def _table_fields(table: dict, fields=None):
+    # The requested fields this table has, since unknown ones are a 422 as well.
+    # A table with none of them returns only its primary field, so records keep a name.
+    if not fields:
+        return fields
+    field_names = _table_field_names(table)
+    present = [field for field in fields if field in field_names]
+    if present:
+        return present
+    primary = [field.get('name') for field in table.get('fields', ()) if field.get('id') == table.get('primaryFieldId')]
+    return primary or None
+
+async def iter_table_records(client, base_id: str, table: dict, headers: dict, modified_since=None, fields=None, filters=None):
+    # Yields one page of records at a time, following `offset` until the table is exhausted
+    if not _can_match(table, filters):
+        return
+    fields = _table_fields(table, fields)
+    formula = filter_formula(filters, modified_since)
+    offset = None
+    while True:
+        records, offset = await fetch_table_records_page(client, base_id, table, headers, offset, formula=formula, fields=fields)
+        yield records
+        if not offset:
+            break
+
+async def fetch_items(client, base_id: str, tables: list, headers: dict, max_concurrency: int = AIRTABLE_MAX_CONCURRENCY, modified_since=None, fields=None, filters=None):
+    # Yields pages of records as they arrive from any table
+    async for records in iter_pages_concurrently(
+        [partial(iter_table_records, client, base_id, table, headers, modified_since, fields, filters) for table in tables],
+        max_concurrency
+    ):
+        yield records
+
+def _airtable_headers(pat: str):
+    return {
         'Authorization': f'Bearer {pat}',
         'Content-Type': 'application/json'
     }
-    
-    # Get tables from Airtable Meta API
-    tables_url = f'https://api.airtable.com/v0/meta/bases/{base_id}/tables'
-    async with httpx.AsyncClient() as client:
-        tables_response = await client.get(tables_url, headers=headers)
-        
-    if tables_response.status_code == 200:
-        tables = tables_response.json().get('tables', [])
-        
-        for table in tables:
-            table_id = table.get('id')
-            table_name = table.get('name')
-            
-            # Get records from specific table
-            records_url = f'https://api.airtable.com/v0/{base_id}/{table_name}'
-            response = await client.get(
-                records_url,
-                headers=headers,
-                params={'offset': offset} if offset else None
-            )
-            
-            if response.status_code == 200:
-                records = response.json().get('records', [])
-                for record in records:
-                    # Add table information to each record
-                    record['table_name'] = table_name
-                    record['table_id'] = table_id
-                    aggregated_response.append(record)
-                
-                offset = response.json().get('offset')
-                if offset:
-                    await fetch_items(base_id, pat, aggregated_response, offset)
-    
-    return aggregated_response
 
-async def get_items_airtable(credentials):
+def _base_item(base_id: str, tables: list):
+    return IntegrationItem(
+        id=base_id,
+        name=base_id,
+        type='base',
+        directory=True,
+        children=[table.get('id') for table in tables]
+    )
+
+async def get_items_airtable(credentials, modified_since=None, fields=None, filters=None):
     if not credentials:
-        return []
+        return
 
+    credentials = json.loads(credentials)
     base_id = credentials.get('base_id')
     pat = credentials.get('pat')
-    
-    aggregated_response = []
-    await fetch_items(base_id, pat, aggregated_response)
-    
-    return [await create_integration_item_metadata_object(
-        record,
-        'record',
-        None,
-        None
-    ) for record in aggregated_response]
-    
-    if tables_response.status_code == 200:
-        tables_response = tables_response.json()
-        for table in tables_response['tables']:
-            list_of_integration_item_metadata.append(
-                create_integration_item_metadata_object(
-                    table,
-                        'Table',
-                        response.get('id', None),
-                        response.get('name', None),
-                    )
-                )
-
-    print(f'list_of_integration_item_metadata: {list_of_integration_item_metadata}')
-    return list_of_integration_item_metadata
+    headers = _airtable_headers(pat)
+
+    client = upstream_client('airtable', f'{pat}:{base_id}')
+    tables = await fetch_tables(client, base_id, headers)
+
+    # The base and its tables come first so that the hierarchy is base -> table -> record
+    yield _base_item(base_id, tables)
+    for table in tables:
+        yield await create_integration_item_metadata_object(table, 'table', base_id, base_id)
+
+    async for records in fetch_items(client, base_id, tables, headers, modified_since=modified_since, fields=fields, filters=filters):
+        for record in records:
+            yield await create_integration_item_metadata_object(
+                record,
+                'record',
+                record.get('table_id'),
+                record.get('table_name')
+            )
+
+async def get_items_page_airtable(credentials, cursor=None, page_size: int = AIRTABLE_PAGE_SIZE, fields=None, filters=None):
+    # Fetches a single upstream page. The cursor holds the table index, the table
+    # being read with Airtable's `offset` into it, and the table count; returns the
+    # page's items and the next cursor (None at the end).
+    if cursor and cursor.get('id'):
+        check_cursor(cursor, {'t': int, 'n': int, 'id': str, 'o': str}, {'name': (str, type(None)), 'f': [str]})
+    elif cursor:
+        check_cursor(cursor, {'t': int})
+    credentials = json.loads(credentials)
+    base_id = credentials.get('base_id')
+    pat = credentials.get('pat')
+    headers = _airtable_headers(pat)
+
+    client = upstream_client('airtable', f'{pat}:{base_id}')
+    items = []
+    if cursor and cursor.get('id'):
+        # Fields were already trimmed to the table when it was started
+        table_index, table_count, offset = cursor['t'], cursor['n'], cursor.get('o')
+        table = {'id': cursor['id'], 'name': cursor.get('name')}
+        table_fields = cursor.get('f')
+    else:
+        # Starting a table: its item leads the page, after the base on the very first one
+        tables = await fetch_tables(client, base_id, headers)
+        if cursor is None:
+            items.append(_base_item(base_id, tables))
+        table_index, table_count, offset = (cursor or {}).get('t', 0), len(tables), None
+        if table_index >= table_count:
+            return items, None
+        table = tables[table_index]
+        items.append(await create_integration_item_metadata_object(table, 'table', base_id, base_id))
+        table_fields = _table_fields(table, fields)
+        if not _can_match(table, filters):
+            return items, ({'t': table_index + 1} if table_index + 1 < table_count else None)
+
+    records, offset = await fetch_table_records_page(
+        client,
+        base_id,
+        table,
+        headers,
+        offset,
+        min(page_size, AIRTABLE_PAGE_SIZE),
+        filter_formula(filters),
+        table_fields
+    )
+    for record in records:
+        items.append(await create_integration_item_metadata_object(record, 'record', record.get('table_id'), record.get('table_name')))
+
+    if offset:
+        next_cursor = {'t': table_index, 'n': table_count, 'id': table.get('id'), 'name': table.get('name'), 'o': offset}
+        if table_fields:
+            next_cursor['f'] = table_fields
+        return items, next_cursor
+    if table_index + 1 < table_count:
+        return items, {'t': table_index + 1}
+    return items, None
+
+# Base64 MAC secret returned when the webhook was created; Airtable signs every
+# notification with it in X-Airtable-Content-MAC
+AIRTABLE_WEBHOOK_SECRET = os.environ.get('AIRTABLE_WEBHOOK_SECRET', '')
+# Record ids per filterByFormula when reading changed records back, keeping URLs short
+AIRTABLE_RECORD_ID_BATCH = 50
+
+def webhook_signature_airtable(body: bytes):
+    return 'hmac-sha256=' + sign_webhook_payload(base64.b64decode(AIRTABLE_WEBHOOK_SECRET), body)
+
+async def parse_webhook_airtable(request: Request, body: bytes):
+    # Notifications only say that a webhook has new payloads; they are listed when applied
+    if not AIRTABLE_WEBHOOK_SECRET:
+        raise HTTPException(status_code=404, detail='Airtable webhooks are not configured')
+    check_webhook_signature(webhook_signature_airtable(body), request.headers.get('x-airtable-content-mac'))
+    notification = json.loads(body)
+    return [{
+        'source': notification['base']['id'],
+        'action': 'sync',
+        'object_type': 'webhook',
+        'object_id': notification['webhook']['id']
+    }]
+
+def _webhook_cursor_key(webhook_id: str):
+    return f'webhook_cursor:airtable:{webhook_id}'
+
+async def _fetch_webhook_payloads(client, base_id: str, webhook_id: str, headers: dict):
+    # Every payload after the stored cursor, and the cursor to store once they are applied
+    cursor = await get_value_redis(_webhook_cursor_key(webhook_id))
+    payloads = []
+    while True:
+        params = {'cursor': cursor} if cursor else {}
+        response = await client.get(f'{AIRTABLE_API_URL}/bases/{base_id}/webhooks/{webhook_id}/payloads', headers=headers, params=params)
+        if response.status_code != 200:
+            raise HTTPException(status_code=response.status_code, detail=f'Failed to list payloads for Airtable webhook {webhook_id}')
+        response_json = parse_json(response)
+        payloads.extend(response_json.get('payloads', []))
+        cursor = response_json.get('cursor')
+        if not response_json.get('mightHaveMore'):
+            return payloads, cursor
+
+def _record_changes(payloads: list):
+    # Ids of created or changed records per table, deleted record ids and deleted table ids
+    changed, deleted_records, deleted_tables = {}, set(), set()
+    for payload in payloads:
+        deleted_tables.update(payload.get('destroyedTableIds', ()))
+        for table_id, table_changes in payload.get('changedTablesById', {}).items():
+            record_ids = changed.setdefault(table_id, set())
+            for key in ('createdRecordsById', 'changedRecordsById'):
+                record_ids.update(table_changes.get(key, {}))
+            destroyed = table_changes.get('destroyedRecordIds', ())
+            deleted_records.update(destroyed)
+            record_ids.difference_update(destroyed)
+        for table_id, table_changes in payload.get('createdTablesById', {}).items():
+            changed.setdefault(table_id, set()).update(table_changes.get('recordsById', {}))
+    return changed, deleted_records, deleted_tables
+
+async def _fetch_records_by_id(client, base_id: str, table: dict, headers: dict, record_ids: list):
+    records = []
+    for start in range(0, len(record_ids), AIRTABLE_RECORD_ID_BATCH):
+        formula = 'OR(' + ', '.join(f"RECORD_ID() = '{record_id}'" for record_id in record_ids[start:start + AIRTABLE_RECORD_ID_BATCH]) + ')'
+        offset = None
+        while True:
+            page, offset = await fetch_table_records_page(client, base_id, table, headers, offset, formula=formula)
+            records.extend(page)
+            if not offset:
+                break
+    return records
+
+async def apply_webhook_events_airtable(credentials, events: list):
+    # Returns the items to upsert, the `type:id` keys to delete and the payload
+    # cursors to save once both are stored
+    credentials = json.loads(credentials)
+    base_id = credentials.get('base_id')
+    pat = credentials.get('pat')
+    headers = _airtable_headers(pat)
+
+    client = upstream_client('airtable', f'{pat}:{base_id}')
+    items, deleted_keys, checkpoints = [], [], {}
+    tables = None
+    for event in events:
+        if event['source'] != base_id:
+            continue
+        payloads, cursor = await _fetch_webhook_payloads(client, base_id, event['object_id'], headers)
+        changed, deleted_records, deleted_tables = _record_changes(payloads)
+        if changed:
+            tables = tables if tables is not None else {table['id']: table for table in await fetch_tables(client, base_id, headers)}
+        for table_id, record_ids in changed.items():
+            table = tables.get(table_id)
+            if table is None:
+                continue
+            items.append(await create_integration_item_metadata_object(table, 'table', base_id, base_id))
+            for record in await _fetch_records_by_id(client, base_id, table, headers, sorted(record_ids)):
+                items.append(await create_integration_item_metadata_object(record, 'record', table_id, table.get('name')))
+        deleted_keys.extend(f'record:{record_id}' for record_id in deleted_records)
+        deleted_keys.extend(f'table:{table_id}' for table_id in deleted_tables)
+        if cursor is not None:
+            checkpoints[_webhook_cursor_key(event['object_id'])] = str(cursor)
+    return items, deleted_keys, checkpoints
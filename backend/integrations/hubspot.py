@@ -1,21 +1,28 @@
 # hubspot.py
-import datetime
 import json
+import os
 import secrets
+import time
 from fastapi import Request, HTTPException
 from fastapi.responses import HTMLResponse
-import httpx
-import asyncio
 import base64
-import hashlib
 
-import requests
 from integrations.integration_item import IntegrationItem
 
-from redis_client import add_key_value_redis, get_value_redis, delete_key_redis
+from metrics import parse_json, profiled
+from pagination import check_cursor
+from token_manager import ensure_fresh_credentials, with_expiry
+from upstream import upstream_client
+from redis_client import add_key_value_redis, add_key_values_redis, get_value_redis
+from webhooks import check_webhook_signature, sign_webhook_payload
 
 
-REDIRECT_URI = 'http://localhost:8000/integrations/hubspot/oauth2callback'
+CLIENT_ID = os.environ.get('CLIENT_ID', '')
+CLIENT_SECRET = os.environ.get('CLIENT_SECRET', '')
+REDIRECT_URI = os.environ.get('REDIRECT_URI', 'http://localhost:8000/integrations/hubspot/oauth2callback')
+
+# Stored credentials carry a refresh token, so they outlive the access token itself
+HUBSPOT_CREDENTIALS_TTL = int(os.environ.get('HUBSPOT_CREDENTIALS_TTL', 30 * 24 * 3600))
 
 authorization_url = (
     f'https://app.hubspot.com/oauth/authorize?'
@@ -84,28 +91,30 @@ async def oauth2callback_hubspot(request: Request):
         if not saved_state or original_state != json.loads(saved_state).get('state'):
             raise HTTPException(status_code=400, detail="State does not match")
             
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                'https://api.hubapi.com/oauth/token',
-                data={
-                    'grant_type': 'authorization_code',
-                    'code': code,
-                    'redirect_uri': REDIRECT_URI,
-                    'client_id': CLIENT_ID,
-                    'client_secret': CLIENT_SECRET
-                },
-                headers={
-                    'Content-Type': 'application/x-www-form-urlencoded',
-                }
-            )
+        client = upstream_client('hubspot', CLIENT_ID)
+        response = await client.post(
+            'https://api.hubapi.com/oauth/token',
+            data={
+                'grant_type': 'authorization_code',
+                'code': code,
+                'redirect_uri': REDIRECT_URI,
+                'client_id': CLIENT_ID,
+                'client_secret': CLIENT_SECRET
+            },
+            headers={
+                'Content-Type': 'application/x-www-form-urlencoded',
+            }
+        )
             
         if response.status_code != 200:
             raise HTTPException(status_code=response.status_code, detail="Failed to get access token")
             
-        credentials = response.json()
-        await add_key_value_redis(f'hubspot_credentials:{org_id}:{user_id}', json.dumps(credentials), expire=600)
-        
-        await delete_key_redis(f'hubspot_state:{org_id}:{user_id}')
+        credentials = with_expiry(response.json())
+        await add_key_values_redis(
+            {f'hubspot_credentials:{org_id}:{user_id}': json.dumps(credentials)},
+            expire=HUBSPOT_CREDENTIALS_TTL,
+            delete=(f'hubspot_state:{org_id}:{user_id}',)
+        )
         
         close_window_script = """
         <html>
@@ -119,34 +128,24 @@ async def oauth2callback_hubspot(request: Request):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-    if not saved_state or original_state != json.loads(saved_state).get('state'):
-        raise HTTPException(status_code=400, detail='State does not match.')
-
-    async with httpx.AsyncClient() as client:
-        response = await client.post(
-            'https://api.hubapi.com/oauth/token',
-            data={
-                'grant_type': 'authorization_code',
-                'code': code,
-                'redirect_uri': REDIRECT_URI,
-                'client_id': CLIENT_ID,
-                'client_secret': CLIENT_SECRET
-            },
-            headers={
-                'Content-Type': 'application/x-www-form-urlencoded',
-            }
-        )
-
-    await add_key_value_redis(f'hubspot_credentials:{org_id}:{user_id}', json.dumps(response.json()), expire=600)
-    
-    close_window_script = """
-    <html>
-        <script>
-            window.close();
-        </script>
-    </html>
-    """
-    return HTMLResponse(content=close_window_script)
+async def refresh_hubspot_token(refresh_token: str):
+    client = upstream_client('hubspot', CLIENT_ID)
+    response = await client.post(
+        'https://api.hubapi.com/oauth/token',
+        data={
+            'grant_type': 'refresh_token',
+            'refresh_token': refresh_token,
+            'redirect_uri': REDIRECT_URI,
+            'client_id': CLIENT_ID,
+            'client_secret': CLIENT_SECRET
+        },
+        headers={
+            'Content-Type': 'application/x-www-form-urlencoded',
+        }
+    )
+    if response.status_code != 200:
+        raise HTTPException(status_code=401, detail="Failed to refresh HubSpot access token, please re-authorize")
+    return response.json()
 
 async def get_hubspot_credentials(user_id: str, org_id: str):
     try:
@@ -156,7 +155,7 @@ async def get_hubspot_credentials(user_id: str, org_id: str):
                 detail="User ID and Organization ID are required"
             )
 
-        credentials = await get_value_redis(f'hubspot_credentials:{org_id}:{user_id}')
+        credentials = await get_value_redis(f'hubspot_credentials:{org_id}:{user_id}', use_local_cache=True)
         
         if not credentials:
             raise HTTPException(
@@ -172,7 +171,11 @@ async def get_hubspot_credentials(user_id: str, org_id: str):
                 detail="Invalid credentials format"
             )
 
-        return {"credentials": parsed_credentials}
+        refreshed_credentials = await ensure_fresh_credentials('hubspot', parsed_credentials, refresh_hubspot_token)
+        if refreshed_credentials is not parsed_credentials:
+            await add_key_value_redis(f'hubspot_credentials:{org_id}:{user_id}', json.dumps(refreshed_credentials), expire=HUBSPOT_CREDENTIALS_TTL)
+
+        return {"credentials": refreshed_credentials}
     except HTTPException as e:
         raise e
     except Exception as e:
@@ -181,6 +184,7 @@ async def get_hubspot_credentials(user_id: str, org_id: str):
             detail=f"Error retrieving credentials: {str(e)}"
         )
 
+@profiled('item_construction')
 async def create_integration_item_metadata_object(response_json, item_type, parent_id=None, parent_name=None):
     # Handle name differently based on item type
     if item_type == 'contact':
@@ -199,86 +203,296 @@ async def create_integration_item_metadata_object(response_json, item_type, pare
         name=name,
         type=item_type,
         parent_id=parent_id,
-        parent_name=parent_name,
+        parent_path_or_name=parent_name,
         properties=response_json,
         url=response_json.get('url')  # Include URL if present
     )
 
-async def get_items_hubspot(credentials):
-    if not credentials:
-        return []
+HUBSPOT_OBJECTS_URL = 'https://api.hubapi.com/crm/v3/objects'
+HUBSPOT_PROPERTIES_URL = 'https://api.hubapi.com/crm/v3/properties'
+
+# HubSpot caps the list and search page size at 100
+HUBSPOT_PAGE_LIMIT = 100
+
+HUBSPOT_OBJECT_PROPERTIES = {
+    'contacts': ['firstname', 'lastname', 'email', 'phone', 'createdate', 'lastmodifieddate', 'hs_lastmodifieddate'],
+    'companies': ['name', 'domain', 'createdate', 'hs_lastmodifieddate'],
+}
+# Always requested under a field projection so that items keep their names
+HUBSPOT_NAME_PROPERTIES = {
+    'contacts': ['firstname', 'lastname'],
+    'companies': ['name'],
+}
+HUBSPOT_FILTER_OPERATORS = {
+    'eq': 'EQ',
+    'neq': 'NEQ',
+    'gt': 'GT',
+    'gte': 'GTE',
+    'lt': 'LT',
+    'lte': 'LTE',
+    'contains': 'CONTAINS_TOKEN',
+}
+
+# How long an object type's property names are reused for scoped loads with one token
+HUBSPOT_PROPERTY_NAMES_TTL = 300
+
+_property_names = {}
+
+def _object_properties(object_type: str, fields=None):
+    # `fields` is None for an unprojected load and [] when a projection names
+    # nothing this object type has, which still fetches the name properties
+    if fields is None:
+        return HUBSPOT_OBJECT_PROPERTIES[object_type]
+    return list(dict.fromkeys([*HUBSPOT_NAME_PROPERTIES[object_type], *fields]))
+
+def _filter_value(value):
+    # HubSpot compares every property value as a string; booleans are 'true'/'false'
+    return str(value).lower() if isinstance(value, bool) else str(value)
 
-    access_token = json.loads(credentials).get('access_token')
-    headers = {
+def _search_filters(filters=None, modified_since=None):
+    search_filters = [
+        {'propertyName': condition['field'], 'operator': HUBSPOT_FILTER_OPERATORS[condition['op']], 'value': _filter_value(condition['value'])}
+        for condition in filters or ()
+    ]
+    if modified_since:
+        search_filters.append({
+            'propertyName': 'hs_lastmodifieddate',
+            'operator': 'GTE',
+            'value': str(int(modified_since.timestamp() * 1000))
+        })
+    return search_filters
+
+async def _list_objects(client, headers, object_type: str, properties: list, after=None, limit: int = HUBSPOT_PAGE_LIMIT):
+    # Asking for the properties on the list call returns hydrated objects, so no
+    # per-object or batch read is needed afterwards
+    params = {'limit': limit, 'properties': ','.join(properties)}
+    if after:
+        params['after'] = after
+    response = await client.get(f'{HUBSPOT_OBJECTS_URL}/{object_type}', headers=headers, params=params)
+    if response.status_code != 200:
+        raise HTTPException(status_code=response.status_code, detail=f"Failed to list HubSpot {object_type}")
+
+    response_json = parse_json(response)
+    return response_json.get('results', []), response_json.get('paging', {}).get('next', {}).get('after')
+
+async def _search_objects(client, headers, object_type: str, properties: list, search_filters: list, after=None, limit: int = HUBSPOT_PAGE_LIMIT):
+    # The CRM search API applies the filters upstream and returns hydrated objects.
+    # Note that HubSpot caps a single search at 10,000 results.
+    body = {
+        'filterGroups': [{'filters': search_filters}],
+        'sorts': [{'propertyName': 'hs_lastmodifieddate', 'direction': 'ASCENDING'}],
+        'properties': properties,
+        'limit': limit
+    }
+    if after:
+        body['after'] = after
+    response = await client.post(f'{HUBSPOT_OBJECTS_URL}/{object_type}/search', headers=headers, json=body, idempotent=True)
+    if response.status_code != 200:
+        raise HTTPException(status_code=response.status_code, detail=f"Failed to search HubSpot {object_type}")
+
+    response_json = parse_json(response)
+    return response_json.get('results', []), response_json.get('paging', {}).get('next', {}).get('after')
+
+async def _fetch_property_names(client, headers, object_type: str):
+    key = (client.rate_key, object_type)
+    cached = _property_names.get(key)
+    if cached is not None and cached[0] > time.monotonic():
+        return cached[1]
+    response = await client.get(f'{HUBSPOT_PROPERTIES_URL}/{object_type}', headers=headers)
+    if response.status_code != 200:
+        raise HTTPException(status_code=response.status_code, detail=f"Failed to list HubSpot {object_type} properties")
+    names = {prop.get('name') for prop in parse_json(response).get('results', [])}
+    now = time.monotonic()
+    for expired in [key for key, (expires_at, _) in _property_names.items() if expires_at <= now]:
+        del _property_names[expired]
+    _property_names[key] = (now + HUBSPOT_PROPERTY_NAMES_TTL, names)
+    return names
+
+async def _object_scope(client, headers, object_type: str, fields=None, filters=None):
+    # Narrows a load scope to one object type, since HubSpot rejects unknown
+    # properties. Returns (fields, filters), or None when a filter names a property
+    # the type does not have, so that none of its objects can match.
+    if not fields and not filters:
+        return fields, filters
+    property_names = await _fetch_property_names(client, headers, object_type)
+    if any(condition['field'] not in property_names for condition in filters or ()):
+        return None
+    return ([field for field in fields if field in property_names] if fields else fields), filters
+
+async def _fetch_objects_page(client, headers, object_type: str, after=None, limit: int = HUBSPOT_PAGE_LIMIT, modified_since=None, fields=None, filters=None):
+    object_scope = await _object_scope(client, headers, object_type, fields, filters)
+    if object_scope is None:
+        return [], None
+    fields, filters = object_scope
+    properties = _object_properties(object_type, fields)
+    search_filters = _search_filters(filters, modified_since)
+    if search_filters:
+        return await _search_objects(client, headers, object_type, properties, search_filters, after, limit)
+    return await _list_objects(client, headers, object_type, properties, after, limit)
+
+async def _iter_objects(client, headers, object_type: str, modified_since=None, fields=None, filters=None):
+    after = None
+    while True:
+        objects, after = await _fetch_objects_page(client, headers, object_type, after, modified_since=modified_since, fields=fields, filters=filters)
+        for obj in objects:
+            yield obj
+        if not after:
+            break
+
+def _contact_item_json(contact):
+    contact_id = contact.get('id')
+    contact_data = contact.get('properties', {})
+    return {
+        'id': contact_id,
+        'name': (contact_data.get('firstname') or '') + ' ' + (contact_data.get('lastname') or ''),
+        'email': contact_data.get('email') or '',
+        'phone': contact_data.get('phone') or '',
+        'properties': contact,
+        'url': f'https://app.hubspot.com/contacts/{contact_id}'
+    }
+
+def _company_item_json(company):
+    company_id = company.get('id')
+    company_data = company.get('properties', {})
+    return {
+        'id': company_id,
+        'name': company_data.get('name') or '',
+        'domain': company_data.get('domain') or '',
+        'properties': company,
+        'url': f'https://app.hubspot.com/companies/{company_id}'
+    }
+
+# Object types in load order, with the item type and item JSON builder of each
+HUBSPOT_ITEM_OBJECTS = (
+    ('contacts', 'contact', _contact_item_json),
+    ('companies', 'company', _company_item_json),
+)
+
+def _hubspot_headers(access_token: str):
+    return {
         'Authorization': f'Bearer {access_token}',
         'Content-Type': 'application/json'
     }
-    
-    async with httpx.AsyncClient() as client:
-        contacts_response = await client.get(
-            'https://api.hubapi.com/crm/v3/objects/contacts',
-            headers=headers
-        )
-        
-        items = []
-        
-        if contacts_response.status_code == 200:
-            contacts = contacts_response.json().get('results', [])
-            for contact in contacts:
-                contact_id = contact.get('id')
-                contact_data = contact.get('properties', {})
-                
-                contact_response = await client.get(
-                    f'https://api.hubapi.com/crm/v3/objects/contacts/{contact_id}',
-                    headers=headers
-                )
-                
-                if contact_response.status_code == 200:
-                    contact_details = contact_response.json()
-                    items.append(await create_integration_item_metadata_object(
-                        {
-                            'id': contact_id,
-                            'name': contact_data.get('firstname', '') + ' ' + contact_data.get('lastname', ''),
-                            'email': contact_data.get('email', ''),
-                            'phone': contact_data.get('phone', ''),
-                            'properties': contact_details,
-                            'url': f'https://app.hubspot.com/contacts/{contact_id}'
-                        },
-                        'contact',
-                        None,
-                        None
-                    ))
-        
-        companies_response = await client.get(
-            'https://api.hubapi.com/crm/v3/objects/companies',
-            headers=headers
+
+async def get_items_hubspot(credentials, modified_since=None, fields=None, filters=None):
+    if not credentials:
+        return
+
+    credentials = await ensure_fresh_credentials('hubspot', json.loads(credentials), refresh_hubspot_token)
+    access_token = credentials.get('access_token')
+    headers = _hubspot_headers(access_token)
+
+    client = upstream_client('hubspot', access_token)
+    for object_type, item_type, item_json in HUBSPOT_ITEM_OBJECTS:
+        async for obj in _iter_objects(client, headers, object_type, modified_since, fields, filters):
+            yield await create_integration_item_metadata_object(
+                item_json(obj),
+                item_type,
+                None,
+                None
+            )
+
+async def get_items_page_hubspot(credentials, cursor=None, page_size: int = HUBSPOT_PAGE_LIMIT, fields=None, filters=None):
+    # Fetches a single upstream page. The cursor holds the object type index and
+    # HubSpot's `after`; returns the page's items and the next cursor (None at the end).
+    if cursor:
+        check_cursor(cursor, {'o': int}, {'a': str})
+    credentials = await ensure_fresh_credentials('hubspot', json.loads(credentials), refresh_hubspot_token)
+    access_token = credentials.get('access_token')
+    headers = _hubspot_headers(access_token)
+
+    client = upstream_client('hubspot', access_token)
+    object_index = (cursor or {}).get('o', 0)
+    if object_index >= len(HUBSPOT_ITEM_OBJECTS):
+        return [], None
+    object_type, item_type, item_json = HUBSPOT_ITEM_OBJECTS[object_index]
+    objects, after = await _fetch_objects_page(
+        client,
+        headers,
+        object_type,
+        (cursor or {}).get('a'),
+        min(page_size, HUBSPOT_PAGE_LIMIT),
+        fields=fields,
+        filters=filters
+    )
+    items = [await create_integration_item_metadata_object(item_json(obj), item_type, None, None) for obj in objects]
+
+    if after:
+        return items, {'o': object_index, 'a': after}
+    if object_index + 1 < len(HUBSPOT_ITEM_OBJECTS):
+        return items, {'o': object_index + 1}
+    return items, None
+
+# HubSpot signs webhook requests with the app's client secret; the signed URI is
+# the target URL configured on the app, which may differ from the one seen behind a proxy
+HUBSPOT_WEBHOOK_URL = os.environ.get('HUBSPOT_WEBHOOK_URL', '')
+# Requests with an older X-HubSpot-Request-Timestamp are rejected as replays
+HUBSPOT_WEBHOOK_MAX_AGE = 300
+# Upserts are read back with the batch API, which takes up to 100 ids per call
+HUBSPOT_BATCH_READ_LIMIT = 100
+
+HUBSPOT_WEBHOOK_OBJECT_TYPES = {'contact': 'contacts', 'company': 'companies'}
+HUBSPOT_WEBHOOK_DELETIONS = ('deletion', 'privacyDeletion')
+HUBSPOT_WEBHOOK_UPSERTS = ('creation', 'propertyChange', 'restore', 'merge')
+
+def webhook_signature_hubspot(method: str, uri: str, body: bytes, timestamp: str):
+    # X-HubSpot-Signature-v3
+    message = method.encode('utf-8') + uri.encode('utf-8') + body + timestamp.encode('utf-8')
+    return sign_webhook_payload(CLIENT_SECRET.encode('utf-8'), message, encoding='base64')
+
+async def parse_webhook_hubspot(request: Request, body: bytes):
+    if not CLIENT_SECRET:
+        raise HTTPException(status_code=404, detail='HubSpot webhooks are not configured')
+    timestamp = request.headers.get('x-hubspot-request-timestamp', '')
+    if not timestamp.isdigit() or abs(time.time() - int(timestamp) / 1000) > HUBSPOT_WEBHOOK_MAX_AGE:
+        raise HTTPException(status_code=401, detail='Stale or missing HubSpot request timestamp')
+    uri = HUBSPOT_WEBHOOK_URL or str(request.url)
+    check_webhook_signature(webhook_signature_hubspot(request.method, uri, body, timestamp), request.headers.get('x-hubspot-signature-v3'))
+
+    events = []
+    for notification in json.loads(body):
+        item_type, _, change = notification.get('subscriptionType', '').partition('.')
+        if item_type not in HUBSPOT_WEBHOOK_OBJECT_TYPES:
+            continue
+        if change in HUBSPOT_WEBHOOK_DELETIONS:
+            action = 'delete'
+        elif change in HUBSPOT_WEBHOOK_UPSERTS:
+            action = 'upsert'
+        else:
+            continue
+        events.append({'source': str(notification.get('portalId')), 'action': action, 'object_type': item_type, 'object_id': str(notification.get('objectId'))})
+    return events
+
+async def _batch_read_objects(client, headers, object_type: str, object_ids: list):
+    objects = []
+    for start in range(0, len(object_ids), HUBSPOT_BATCH_READ_LIMIT):
+        response = await client.post(
+            f'{HUBSPOT_OBJECTS_URL}/{object_type}/batch/read',
+            headers=headers,
+            json={
+                'properties': HUBSPOT_OBJECT_PROPERTIES[object_type],
+                'inputs': [{'id': object_id} for object_id in object_ids[start:start + HUBSPOT_BATCH_READ_LIMIT]]
+            },
+            idempotent=True
         )
-        
-        if companies_response.status_code == 200:
-            companies = companies_response.json().get('results', [])
-            for company in companies:
-                company_id = company.get('id')
-                company_data = company.get('properties', {})
-                
-                company_response = await client.get(
-                    f'https://api.hubapi.com/crm/v3/objects/companies/{company_id}',
-                    headers=headers
-                )
-                
-                if company_response.status_code == 200:
-                    company_details = company_response.json()
-                    items.append(await create_integration_item_metadata_object(
-                        {
-                            'id': company_id,
-                            'name': company_data.get('name', ''),
-                            'domain': company_data.get('domain', ''),
-                            'properties': company_details,
-                            'url': f'https://app.hubspot.com/companies/{company_id}'
-                        },
-                        'company',
-                        None,
-                        None
-                    ))
-        
-        return items
-    return []
\ No newline at end of file
+        # 207 when some of the objects were deleted again in the meantime
+        if response.status_code not in (200, 207):
+            raise HTTPException(status_code=response.status_code, detail=f"Failed to read HubSpot {object_type}")
+        objects.extend(parse_json(response).get('results', []))
+    return objects
+
+async def apply_webhook_events_hubspot(credentials, events: list):
+    # Returns the items to upsert, the `type:id` keys to delete and no checkpoints
+    credentials = await ensure_fresh_credentials('hubspot', json.loads(credentials), refresh_hubspot_token)
+    access_token = credentials.get('access_token')
+    headers = _hubspot_headers(access_token)
+
+    client = upstream_client('hubspot', access_token)
+    deleted_keys = [f"{event['object_type']}:{event['object_id']}" for event in events if event['action'] == 'delete']
+    items = []
+    for object_type, item_type, item_json in HUBSPOT_ITEM_OBJECTS:
+        object_ids = [event['object_id'] for event in events if event['action'] == 'upsert' and event['object_type'] == item_type]
+        if object_ids:
+            for obj in await _batch_read_objects(client, headers, object_type, object_ids):
+                items.append(await create_integration_item_metadata_object(item_json(obj), item_type, None, None))
+    return items, deleted_keys, {}
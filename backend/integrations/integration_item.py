@@ -1,7 +1,27 @@
+import json
 from datetime import datetime
 from typing import Optional, List
 
 class IntegrationItem:
+    # Slotted to drop the per-instance __dict__; loads can hold hundreds of thousands of items
+    __slots__ = (
+        'id',
+        'type',
+        'directory',
+        'parent_path_or_name',
+        'parent_id',
+        'name',
+        'creation_time',
+        'last_modified_time',
+        'url',
+        'children',
+        'mime_type',
+        'delta',
+        'drive_id',
+        'visibility',
+        'properties',
+    )
+
     def __init__(
         self,
         id: Optional[str] = None,
@@ -18,6 +38,7 @@ class IntegrationItem:
         delta: Optional[str] = None,
         drive_id: Optional[str] = None,
         visibility: Optional[bool] = True,
+        properties: Optional[dict] = None,
     ):
         self.id = id
         self.type = type
@@ -33,3 +54,48 @@ class IntegrationItem:
         self.delta = delta
         self.drive_id = drive_id
         self.visibility = visibility
+        self.properties = properties
+
+    def __repr__(self):
+        return f'IntegrationItem(id={self.id!r}, type={self.type!r}, name={self.name!r})'
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        return cls(**{name: data[name] for name in cls.__slots__ if name in data})
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'type': self.type,
+            'directory': self.directory,
+            'parent_path_or_name': self.parent_path_or_name,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'creation_time': _encode_datetime(self.creation_time),
+            'last_modified_time': _encode_datetime(self.last_modified_time),
+            'url': self.url,
+            'children': self.children,
+            'mime_type': self.mime_type,
+            'delta': self.delta,
+            'drive_id': self.drive_id,
+            'visibility': self.visibility,
+            'properties': self.properties,
+        }
+
+    def to_json(self) -> bytes:
+        return _json_encoder.encode(self.to_dict()).encode('utf-8')
+
+def _encode_datetime(value):
+    # Providers hand us ISO strings already; only real datetimes need converting
+    return value.isoformat() if isinstance(value, datetime) else value
+
+def _encode_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+_json_encoder = json.JSONEncoder(separators=(',', ':'), ensure_ascii=False, default=_encode_default)
+
+def encode_integration_items(items) -> bytes:
+    # Encodes a list of items as a JSON array without going through jsonable_encoder
+    return b'[' + b','.join(item.to_json() for item in items) + b']'
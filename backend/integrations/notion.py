@@ -1,16 +1,26 @@
 # notion.py
 
 import json
-import secrets
+import os
 from fastapi import Request, HTTPException
 from fastapi.responses import HTMLResponse
-import httpx
-import asyncio
-import base64
-import requests
+from functools import partial
 from integrations.integration_item import IntegrationItem
 
-from redis_client import add_key_value_redis, get_value_redis, delete_key_redis
+from metrics import parse_json, profiled
+from pagination import check_cursor
+from upstream import iter_pages_concurrently, upstream_client
+from redis_client import add_key_value_redis, add_key_values_redis, get_value_redis, delete_key_redis
+from webhooks import check_webhook_signature, sign_webhook_payload
+
+INTEGRATION_TOKEN = os.environ.get('INTEGRATION_TOKEN', '')
+
+NOTION_API_URL = os.environ.get('NOTION_API_URL', 'https://api.notion.com/v1')
+NOTION_API_VERSION = os.environ.get('NOTION_API_VERSION', '2023-08-01')
+
+# Notion caps page_size at 100 and allows roughly 3 requests per second per integration
+NOTION_PAGE_SIZE = 100
+NOTION_MAX_CONCURRENCY = int(os.environ.get('NOTION_MAX_CONCURRENCY', 3))
 
 
 async def authorize_notion(user_id, org_id):
@@ -36,24 +46,25 @@ async def oauth2callback_notion(request: Request):
     if not saved_state or original_state != json.loads(saved_state).get('state'):
         raise HTTPException(status_code=400, detail='State does not match.')
 
-    async with httpx.AsyncClient() as client:
-        response, _ = await asyncio.gather(
-            client.post(
-                'https://api.notion.com/v1/oauth/token',
-                json={
-                    'grant_type': 'authorization_code',
-                    'code': code,
-                    'redirect_uri': REDIRECT_URI
-                }, 
-                headers={
-                    'Authorization': f'Basic {encoded_client_id_secret}',
-                    'Content-Type': 'application/json',
-                }
-            ),
-            delete_key_redis(f'notion_state:{org_id}:{user_id}'),
-        )
+    client = upstream_client('notion', encoded_client_id_secret)
+    response = await client.post(
+        'https://api.notion.com/v1/oauth/token',
+        json={
+            'grant_type': 'authorization_code',
+            'code': code,
+            'redirect_uri': REDIRECT_URI
+        }, 
+        headers={
+            'Authorization': f'Basic {encoded_client_id_secret}',
+            'Content-Type': 'application/json',
+        }
+    )
 
-    await add_key_value_redis(f'notion_credentials:{org_id}:{user_id}', json.dumps(response.json()), expire=600)
+    await add_key_values_redis(
+        {f'notion_credentials:{org_id}:{user_id}': json.dumps(response.json())},
+        expire=600,
+        delete=(f'notion_state:{org_id}:{user_id}',)
+    )
     
     close_window_script = """
     <html>
@@ -65,7 +76,7 @@ async def oauth2callback_notion(request: Request):
     return HTMLResponse(content=close_window_script)
 
 async def get_notion_credentials(user_id, org_id):
-    credentials = await get_value_redis(f'notion_credentials:{org_id}:{user_id}')
+    credentials = await get_value_redis(f'notion_credentials:{org_id}:{user_id}', use_local_cache=True)
     if not credentials:
         raise HTTPException(status_code=400, detail='No credentials found.')
     credentials = json.loads(credentials)
@@ -92,10 +103,49 @@ def _recursive_dict_search(data, target_key):
                         return result
     return None
 
+def _plain_text(rich_text):
+    return ''.join(part.get('plain_text', '') for part in rich_text or ())
+
+class NotionPropertyExtractor:
+    # Compiled once per database from its schema (or one of its rows, whose
+    # properties carry the same types) so that every row is read with direct
+    # lookups instead of a deep search through the page payload
+    __slots__ = ('title_property', 'rich_text_properties')
+
+    def __init__(self, database: dict):
+        self.title_property = None
+        self.rich_text_properties = []
+        for property_name, schema in database.get('properties', {}).items():
+            if schema.get('type') == 'title':
+                self.title_property = property_name
+            elif schema.get('type') == 'rich_text':
+                self.rich_text_properties.append(property_name)
+
+    def name(self, page: dict):
+        properties = page.get('properties', {})
+        if self.title_property is not None:
+            name = _plain_text(properties.get(self.title_property, {}).get('title'))
+            if name:
+                return name
+        for property_name in self.rich_text_properties:
+            name = _plain_text(properties.get(property_name, {}).get('rich_text'))
+            if name:
+                return name
+        return None
+
+@profiled('item_construction')
 def create_integration_item_metadata_object(
     response_json: str,
+    extractor: NotionPropertyExtractor = None,
 ) -> IntegrationItem:
-    name = _recursive_dict_search(response_json['properties'], 'content')
+    if extractor is not None:
+        name = extractor.name(response_json)
+    elif response_json['object'] == 'database':
+        name = _plain_text(response_json.get('title')) or None
+    else:
+        # Pages without a known database schema fall back to searching the payload
+        name = _recursive_dict_search(response_json['properties'], 'content')
+        name = _recursive_dict_search(response_json, 'content') if name is None else name
     parent_type = (
         ''
         if response_json['parent']['type'] is None
@@ -108,76 +158,298 @@ def create_integration_item_metadata_object(
             response_json['parent'][parent_type]
         )
 
-    name = _recursive_dict_search(response_json, 'content') if name is None else name
     name = 'multi_select' if name is None else name
     name = response_json['object'] + ' ' + name
 
     integration_item_metadata = IntegrationItem(
         id=response_json['id'],
         type=response_json['object'],
+        directory=response_json['object'] == 'database',
         name=name,
         creation_time=response_json['created_time'],
         last_modified_time=response_json['last_edited_time'],
         parent_id=parent_id,
+        url=response_json.get('url'),
+        properties=response_json.get('properties'),
     )
 
     return integration_item_metadata
 
-async def get_items_notion(credentials):
-    if not credentials:
-        return []
+async def _fetch_result_page(client, url: str, headers: dict, body: dict, params=None, start_cursor=None):
+    # One page of results and the cursor of the next one (None at the end)
+    response = await client.post(
+        url,
+        headers=headers,
+        params=params,
+        json={**body, 'start_cursor': start_cursor} if start_cursor else body,
+        idempotent=True
+    )
+    if response.status_code != 200:
+        raise HTTPException(status_code=response.status_code, detail=f'Notion request to {url} failed')
 
-    integration_token = credentials.get('integration_token')
-    headers = {
+    response_json = parse_json(response)
+    next_cursor = response_json.get('next_cursor') if response_json.get('has_more') else None
+    return response_json.get('results', []), next_cursor
+
+async def _iter_result_pages(client, url: str, headers: dict, body: dict, params=None):
+    # Yields each page of results, following `next_cursor` while `has_more` is set
+    start_cursor = None
+    while True:
+        results, start_cursor = await _fetch_result_page(client, url, headers, body, params, start_cursor)
+        yield results
+        if not start_cursor:
+            break
+
+NOTION_DATABASE_SEARCH = {
+    'filter': {
+        'property': 'object',
+        'value': 'database'
+    },
+    'page_size': NOTION_PAGE_SIZE
+}
+
+async def fetch_databases(client, headers: dict):
+    databases = []
+    async for results in _iter_result_pages(client, f'{NOTION_API_URL}/search', headers, NOTION_DATABASE_SEARCH):
+        databases.extend(results)
+    return databases
+
+# Database query filter conditions per property type, keyed by load filter operator
+_NOTION_TEXT_CONDITIONS = {'eq': 'equals', 'neq': 'does_not_equal', 'contains': 'contains'}
+_NOTION_EQUALITY_CONDITIONS = {'eq': 'equals', 'neq': 'does_not_equal'}
+NOTION_FILTER_CONDITIONS = {
+    'title': _NOTION_TEXT_CONDITIONS,
+    'rich_text': _NOTION_TEXT_CONDITIONS,
+    'url': _NOTION_TEXT_CONDITIONS,
+    'email': _NOTION_TEXT_CONDITIONS,
+    'phone_number': _NOTION_TEXT_CONDITIONS,
+    'number': {
+        'eq': 'equals',
+        'neq': 'does_not_equal',
+        'gt': 'greater_than',
+        'gte': 'greater_than_or_equal_to',
+        'lt': 'less_than',
+        'lte': 'less_than_or_equal_to',
+    },
+    'date': {'eq': 'equals', 'gt': 'after', 'gte': 'on_or_after', 'lt': 'before', 'lte': 'on_or_before'},
+    'checkbox': _NOTION_EQUALITY_CONDITIONS,
+    'select': _NOTION_EQUALITY_CONDITIONS,
+    'status': _NOTION_EQUALITY_CONDITIONS,
+    'multi_select': {'contains': 'contains', 'neq': 'does_not_contain'},
+}
+
+def _property_filter(database: dict, condition: dict):
+    schema = database.get('properties', {})[condition['field']]
+    conditions = NOTION_FILTER_CONDITIONS.get(schema.get('type'), {})
+    if condition['op'] not in conditions:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Operator {condition['op']} is not supported for Notion {schema.get('type')} property {condition['field']}"
+        )
+    return {'property': condition['field'], schema['type']: {conditions[condition['op']]: condition['value']}}
+
+def database_query_filter(database: dict, filters=None, modified_since=None):
+    # Builds the query `filter` for one database from its schema; None when unfiltered
+    query_filters = [_property_filter(database, condition) for condition in filters or ()]
+    if modified_since:
+        query_filters.append({
+            'timestamp': 'last_edited_time',
+            'last_edited_time': {'on_or_after': modified_since.isoformat()}
+        })
+    if len(query_filters) > 1:
+        return {'and': query_filters}
+    return query_filters[0] if query_filters else None
+
+def database_filter_properties(database: dict, fields=None):
+    # Property ids for `filter_properties`; the title is always kept so items keep their names
+    if not fields:
+        return None
+    property_ids = [
+        schema.get('id')
+        for property_name, schema in database.get('properties', {}).items()
+        if property_name in fields or schema.get('type') == 'title'
+    ]
+    return property_ids or None
+
+def _database_query(database: dict, modified_since=None, fields=None, filters=None, page_size: int = NOTION_PAGE_SIZE):
+    # URL, body and query parameters of a database query
+    body = {'page_size': page_size}
+    query_filter = database_query_filter(database, filters, modified_since)
+    if query_filter:
+        body['filter'] = query_filter
+    filter_properties = database_filter_properties(database, fields)
+    return (
+        f"{NOTION_API_URL}/databases/{database.get('id')}/query",
+        body,
+        {'filter_properties': filter_properties} if filter_properties else None
+    )
+
+def _can_match(database: dict, filters=None):
+    # Rows of a database without a filtered property can never match
+    return all(condition['field'] in database.get('properties', {}) for condition in filters or ())
+
+async def _iter_database_items(client, database: dict, headers: dict, modified_since=None, fields=None, filters=None):
+    if not _can_match(database, filters):
+        return
+    extractor = NotionPropertyExtractor(database)
+    url, body, params = _database_query(database, modified_since, fields, filters)
+    async for entries in _iter_result_pages(client, url, headers, body, params):
+        yield [create_integration_item_metadata_object(entry, extractor) for entry in entries]
+
+async def fetch_database(client, headers: dict, database_id: str):
+    response = await client.get(f'{NOTION_API_URL}/databases/{database_id}', headers=headers)
+    if response.status_code != 200:
+        raise HTTPException(status_code=response.status_code, detail=f'Failed to retrieve Notion database {database_id}')
+    return parse_json(response)
+
+def _notion_headers(integration_token: str):
+    return {
         'Authorization': f'Bearer {integration_token}',
         'Notion-Version': NOTION_API_VERSION,
         'Content-Type': 'application/json'
     }
-    
-    async with httpx.AsyncClient() as client:
-        databases_url = f'{NOTION_API_URL}/search'
-        response = await client.post(
-            databases_url,
-            headers=headers,
-            json={
-                'filter': {
-                    'property': 'object',
-                    'value': 'database'
-                }
-            }
-        )
-        
-    if response.status_code == 200:
-        results = response.json().get('results', [])
-        items = []
-        
-        for database in results:
-            database_id = database.get('id')
-            database_name = database.get('title', [{}])[0].get('plain_text', '')
-            
-            entries_url = f'{NOTION_API_URL}/databases/{database_id}/query'
-            entries_response = await client.post(
-                entries_url,
-                headers=headers,
-                json={}
-            )
-            
-            if entries_response.status_code == 200:
-                entries = entries_response.json().get('results', [])
-                for entry in entries:
-                    items.append(await create_integration_item_metadata_object(
-                        {
-                            'id': entry.get('id'),
-                            'name': entry.get('properties', {}).get('Name', {}).get('title', [{}])[0].get('plain_text', ''),
-                            'database': database_name,
-                            'database_id': database_id,
-                            'properties': entry.get('properties', {}),
-                            'url': f'https://www.notion.so/{entry.get("id")}'
-                        },
-                        'notion_item',
-                        None,
-                        None
-                    ))
-        
-        return items
-    return []
+
+async def get_items_notion(credentials, max_concurrency: int = NOTION_MAX_CONCURRENCY, modified_since=None, fields=None, filters=None):
+    if not credentials:
+        return
+
+    credentials = json.loads(credentials)
+    integration_token = credentials.get('integration_token')
+    headers = _notion_headers(integration_token)
+
+    client = upstream_client('notion', integration_token)
+    databases = await fetch_databases(client, headers)
+    # Databases come first so that the hierarchy is workspace -> database -> page
+    for database in databases:
+        yield create_integration_item_metadata_object(database)
+
+    # Yields each page of items as soon as its database query returns
+    async for items in iter_pages_concurrently(
+        [partial(_iter_database_items, client, database, headers, modified_since, fields, filters) for database in databases],
+        max_concurrency
+    ):
+        for item in items:
+            yield item
+
+def _next_database_cursor(search_cursor, database_index: int, database_count: int, search_next):
+    # The position of the database after this one: later in the same /search page,
+    # the start of the next one, or None at the end
+    if database_index + 1 < database_count:
+        return {'i': database_index + 1, **({'s': search_cursor} if search_cursor else {})}
+    if search_next:
+        return {'i': 0, 's': search_next}
+    return None
+
+async def get_items_page_notion(credentials, cursor=None, page_size: int = NOTION_PAGE_SIZE, fields=None, filters=None):
+    # Fetches a single upstream page. The cursor holds the /search page the database
+    # came from (its start cursor, the database's index and count in it, and the next
+    # search cursor) and, while a database is being read, its id and Notion's
+    # `next_cursor` into it; returns the page's items and the next cursor (None at the end).
+    if cursor and cursor.get('id'):
+        check_cursor(cursor, {'i': int, 'n': int, 'id': str, 'c': str}, {'s': str, 'x': str})
+    elif cursor:
+        check_cursor(cursor, {'i': int}, {'s': str})
+    credentials = json.loads(credentials)
+    integration_token = credentials.get('integration_token')
+    headers = _notion_headers(integration_token)
+
+    client = upstream_client('notion', integration_token)
+    cursor = cursor or {}
+    search_cursor, database_index = cursor.get('s'), cursor['i'] if cursor else 0
+    items = []
+    if cursor.get('id'):
+        database_count, search_next, start_cursor = cursor['n'], cursor.get('x'), cursor['c']
+        # Filters and projections are built from the schema; names come from the rows
+        database = await fetch_database(client, headers, cursor['id']) if fields or filters else {'id': cursor['id']}
+    else:
+        # Starting a database: only its /search page is read, and its item leads the page
+        databases, search_next = await _fetch_result_page(client, f'{NOTION_API_URL}/search', headers, NOTION_DATABASE_SEARCH, start_cursor=search_cursor)
+        database_count, start_cursor = len(databases), None
+        if database_index >= database_count:
+            return items, None
+        database = databases[database_index]
+        items.append(create_integration_item_metadata_object(database))
+
+    next_cursor = None
+    if _can_match(database, filters):
+        url, body, params = _database_query(database, fields=fields, filters=filters, page_size=min(page_size, NOTION_PAGE_SIZE))
+        entries, next_cursor = await _fetch_result_page(client, url, headers, body, params, start_cursor)
+        if entries:
+            extractor = NotionPropertyExtractor(database if 'properties' in database else entries[0])
+            items.extend(create_integration_item_metadata_object(entry, extractor) for entry in entries)
+
+    if next_cursor:
+        position = {'i': database_index, 'n': database_count, 'id': database.get('id'), 'c': next_cursor, 's': search_cursor, 'x': search_next}
+        return items, {key: value for key, value in position.items() if value is not None}
+    return items, _next_database_cursor(search_cursor, database_index, database_count, search_next)
+
+# The verification_token Notion sent when the webhook subscription was created;
+# it is also the key of the X-Notion-Signature HMAC
+NOTION_WEBHOOK_SECRET = os.environ.get('NOTION_WEBHOOK_SECRET', '')
+# How long a verification token received during subscription setup stays readable
+NOTION_VERIFICATION_TOKEN_TTL = 3600
+
+NOTION_WEBHOOK_ENTITY_TYPES = ('page', 'database')
+NOTION_WEBHOOK_DELETIONS = ('deleted',)
+
+def webhook_signature_notion(body: bytes):
+    return 'sha256=' + sign_webhook_payload(NOTION_WEBHOOK_SECRET.encode('utf-8'), body)
+
+async def parse_webhook_notion(request: Request, body: bytes):
+    payload = json.loads(body)
+    if 'verification_token' in payload and not NOTION_WEBHOOK_SECRET:
+        # Subscription setup: the token has to be confirmed in Notion and then
+        # configured as NOTION_WEBHOOK_SECRET; until then it is kept for the operator
+        await add_key_value_redis('webhook_verification_token:notion', payload['verification_token'], expire=NOTION_VERIFICATION_TOKEN_TTL)
+        return []
+    if not NOTION_WEBHOOK_SECRET:
+        raise HTTPException(status_code=404, detail='Notion webhooks are not configured')
+    check_webhook_signature(webhook_signature_notion(body), request.headers.get('x-notion-signature'))
+
+    entity = payload.get('entity') or {}
+    object_type, _, change = payload.get('type', '').partition('.')
+    if object_type not in NOTION_WEBHOOK_ENTITY_TYPES or entity.get('type') != object_type:
+        return []
+    return [{
+        'source': payload.get('workspace_id'),
+        'action': 'delete' if change in NOTION_WEBHOOK_DELETIONS else 'upsert',
+        'object_type': object_type,
+        'object_id': entity.get('id')
+    }]
+
+async def _fetch_entity(client, headers: dict, object_type: str, object_id: str):
+    # A page or database; None when it is gone or no longer shared with the integration
+    response = await client.get(f'{NOTION_API_URL}/{object_type}s/{object_id}', headers=headers)
+    if response.status_code == 404:
+        return None
+    if response.status_code != 200:
+        raise HTTPException(status_code=response.status_code, detail=f'Failed to retrieve Notion {object_type} {object_id}')
+    return parse_json(response)
+
+async def apply_webhook_events_notion(credentials, events: list):
+    # Returns the items to upsert, the `type:id` keys to delete and no checkpoints
+    credentials = json.loads(credentials)
+    integration_token = credentials.get('integration_token')
+    headers = _notion_headers(integration_token)
+
+    client = upstream_client('notion', integration_token)
+    items, deleted_keys = [], []
+    extractors = {}
+    for event in events:
+        object_type, object_id = event['object_type'], event['object_id']
+        response_json = None
+        if event['action'] == 'upsert':
+            response_json = await _fetch_entity(client, headers, object_type, object_id)
+        if response_json is None or response_json.get('archived') or response_json.get('in_trash'):
+            deleted_keys.append(f'{object_type}:{object_id}')
+            continue
+
+        extractor = None
+        database_id = response_json['parent'].get('database_id')
+        if object_type == 'page' and database_id:
+            # Database rows are named from their title property, as in a full load
+            if database_id not in extractors:
+                extractors[database_id] = NotionPropertyExtractor(await fetch_database(client, headers, database_id))
+            extractor = extractors[database_id]
+        items.append(create_integration_item_metadata_object(response_json, extractor))
+    return items, deleted_keys, {}
@@ -1,4 +1,5 @@
 import asyncio
+import json
 from hubspot import authorize_hubspot, oauth2callback_hubspot, get_items_hubspot
 from redis_client import add_key_value_redis, get_value_redis
 
@@ -17,7 +18,7 @@ async def test_hubspot_integration():
     await add_key_value_redis("hubspot_credentials:test_org:test_user", json.dumps(test_credentials), expire=600)
     
     print("\nTesting Getting Items...")
-    items = await get_items_hubspot(test_credentials)
+    items = [item async for item in get_items_hubspot(json.dumps(test_credentials))]
     print(f"Retrieved {len(items)} items")
     
     if items:
@@ -0,0 +1,113 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+import uuid
+
+from integrations.integration_item import IntegrationItem, encode_integration_items
+from redis_client import add_key_value_if_absent_redis, add_key_value_redis, delete_key_if_value_redis, get_value_redis
+
+logger = logging.getLogger(__name__)
+
+# Seconds a cached load is served as-is; set to 0 to disable the cache
+ITEM_CACHE_FRESH_TTL = int(os.environ.get('ITEM_CACHE_FRESH_TTL', 60))
+# Seconds after that during which the stale copy is still served while it is refreshed
+ITEM_CACHE_STALE_TTL = int(os.environ.get('ITEM_CACHE_STALE_TTL', 600))
+# Loads larger than this are not cached: the copy would be held in memory and
+# written as one Redis value
+ITEM_CACHE_MAX_ITEMS = int(os.environ.get('ITEM_CACHE_MAX_ITEMS', 50_000))
+# Upper bound on a single background refresh; also the refresh lock TTL
+ITEM_CACHE_REFRESH_TIMEOUT = int(os.environ.get('ITEM_CACHE_REFRESH_TIMEOUT', 300))
+
+_refresh_tasks = set()
+
+# Fields a token refresh rewrites; credentials that can be refreshed are identified
+# by the rest (notably the refresh token), which stays the same for the account
+ROTATING_CREDENTIAL_FIELDS = ('access_token', 'expires_at', 'expires_in')
+
+def credential_identity(credentials):
+    # Stable hash of the account a credential belongs to
+    if isinstance(credentials, str):
+        try:
+            credentials = json.loads(credentials)
+        except json.JSONDecodeError:
+            pass
+    if isinstance(credentials, dict) and credentials.get('refresh_token'):
+        credentials = {key: value for key, value in credentials.items() if key not in ROTATING_CREDENTIAL_FIELDS}
+    payload = json.dumps(credentials, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def credential_fingerprint(credentials, scope=None):
+    # Stable hash of the credential's account plus whatever narrows the load
+    # (fields, filters, ...). Cache, coalescing, delta and index keys all use it,
+    # so none of them change when a token is refreshed.
+    payload = json.dumps([credential_identity(credentials), scope], sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def item_cache_key(provider: str, credentials, scope=None):
+    return f'item_cache:{provider}:{credential_fingerprint(credentials, scope)}'
+
+async def store_cached_items(key: str, items: list):
+    entry = b'{"fetched_at":%f,"items":%s}' % (time.time(), encode_integration_items(items))
+    await add_key_value_redis(key, entry.decode('utf-8'), expire=ITEM_CACHE_FRESH_TTL + ITEM_CACHE_STALE_TTL)
+
+async def _collect_and_store(key: str, loader):
+    items = []
+    async for item in loader():
+        items.append(item)
+        if len(items) > ITEM_CACHE_MAX_ITEMS:
+            # Left to expire; later misses stream from upstream uncached
+            logger.info('Not caching %s: more than %d items', key, ITEM_CACHE_MAX_ITEMS)
+            return
+    await store_cached_items(key, items)
+
+async def _refresh(key: str, loader, lock_id: str):
+    try:
+        # The crawl counts towards the timeout too, so a refresh never outlives its lock
+        await asyncio.wait_for(_collect_and_store(key, loader), ITEM_CACHE_REFRESH_TIMEOUT)
+    except Exception:
+        logger.exception('Background refresh of %s failed', key)
+    finally:
+        await delete_key_if_value_redis(f'{key}:refreshing', lock_id)
+
+async def _schedule_refresh(key: str, loader):
+    # Only one worker refreshes a given entry at a time
+    lock_id = uuid.uuid4().hex
+    if not await add_key_value_if_absent_redis(f'{key}:refreshing', lock_id, expire=ITEM_CACHE_REFRESH_TIMEOUT):
+        return
+    task = asyncio.create_task(_refresh(key, loader, lock_id))
+    _refresh_tasks.add(task)
+    task.add_done_callback(_refresh_tasks.discard)
+
+async def iter_cached_items(provider: str, credentials, loader, scope=None, fill: bool = True):
+    # `loader` is a zero-argument callable returning the provider's item iterator.
+    # Fresh entries are served straight from Redis, stale ones are served and
+    # refreshed in the background, and misses stream from upstream while filling
+    # the cache, unless `fill` is off (streamed responses keep memory flat) or the
+    # load outgrows ITEM_CACHE_MAX_ITEMS.
+    if ITEM_CACHE_FRESH_TTL <= 0:
+        async for item in loader():
+            yield item
+        return
+
+    key = item_cache_key(provider, credentials, scope)
+    cached = await get_value_redis(key)
+    if cached:
+        entry = json.loads(cached)
+        if time.time() - entry['fetched_at'] > ITEM_CACHE_FRESH_TTL:
+            await _schedule_refresh(key, loader)
+        for item in entry['items']:
+            yield IntegrationItem.from_dict(item)
+        return
+
+    items = [] if fill else None
+    async for item in loader():
+        if items is not None:
+            items.append(item)
+            if len(items) > ITEM_CACHE_MAX_ITEMS:
+                items = None
+        yield item
+    if items is not None:
+        await store_cached_items(key, items)
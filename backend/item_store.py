@@ -0,0 +1,198 @@
+import asyncio
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from fastapi import HTTPException
+
+from item_cache import credential_identity
+
+logger = logging.getLogger(__name__)
+
+# On-disk SQLite database holding every item loaded from upstream, so searches
+# need neither Redis nor the provider APIs; an empty path disables the store.
+# Rows belong to the credential's account (credential_identity), so a token
+# refresh neither orphans them nor hides them from search.
+ITEM_STORE_PATH = os.environ.get('ITEM_STORE_PATH', 'item_store.sqlite3')
+# Property names whose values are full-text indexed next to item names
+ITEM_STORE_SEARCH_PROPERTIES = [
+    name.strip() for name in os.environ.get('ITEM_STORE_SEARCH_PROPERTIES', 'email,domain,table,Notes').split(',') if name.strip()
+]
+ITEM_STORE_WRITE_BATCH = int(os.environ.get('ITEM_STORE_WRITE_BATCH', 500))
+ITEM_STORE_MAX_RESULTS = 200
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS items (
+    rowid INTEGER PRIMARY KEY,
+    tenant TEXT NOT NULL,
+    provider TEXT NOT NULL,
+    item_key TEXT NOT NULL,
+    data TEXT NOT NULL,
+    updated_at REAL NOT NULL,
+    UNIQUE (tenant, provider, item_key)
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS items_fts USING fts5(tenant, name, content, prefix='2 3');
+'''
+
+_connection = None
+_lock = threading.Lock()
+
+def _connect():
+    global _connection
+    if _connection is None:
+        _connection = sqlite3.connect(ITEM_STORE_PATH, check_same_thread=False)
+        _connection.execute('PRAGMA journal_mode=WAL')
+        _connection.execute('PRAGMA synchronous=NORMAL')
+        _connection.executescript(SCHEMA)
+    return _connection
+
+def _property_text(value, depth: int = 0):
+    # Strings found in a property value, including Notion rich text and titles
+    if isinstance(value, str):
+        return [value]
+    if depth > 3:
+        return []
+    if isinstance(value, dict):
+        if 'plain_text' in value:
+            return [value['plain_text']]
+        return [text for nested in value.values() for text in _property_text(nested, depth + 1)]
+    if isinstance(value, list):
+        return [text for nested in value for text in _property_text(nested, depth + 1)]
+    return []
+
+def _searchable_properties(properties, found: list, depth: int = 0):
+    if not isinstance(properties, dict) or depth > 2:
+        return found
+    for key, value in properties.items():
+        if key in ITEM_STORE_SEARCH_PROPERTIES:
+            found.extend(_property_text(value))
+        elif isinstance(value, dict):
+            _searchable_properties(value, found, depth + 1)
+    return found
+
+def _write_items(tenant: str, provider: str, items: list, written_at: float):
+    connection = _connect()
+    with _lock, connection:
+        for item in items:
+            rowid = connection.execute(
+                'INSERT INTO items (tenant, provider, item_key, data, updated_at) VALUES (?, ?, ?, ?, ?) '
+                'ON CONFLICT (tenant, provider, item_key) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at '
+                'RETURNING rowid',
+                (tenant, provider, f'{item.type}:{item.id}', item.to_json().decode('utf-8'), written_at)
+            ).fetchone()[0]
+            connection.execute('DELETE FROM items_fts WHERE rowid = ?', (rowid,))
+            connection.execute(
+                'INSERT INTO items_fts (rowid, tenant, name, content) VALUES (?, ?, ?, ?)',
+                (rowid, tenant, item.name or '', ' '.join(_searchable_properties(item.properties, [])))
+            )
+
+def _prune_items(tenant: str, provider: str, loaded_before: float):
+    # Drops items a complete load no longer returned
+    connection = _connect()
+    with _lock, connection:
+        connection.execute(
+            'DELETE FROM items_fts WHERE rowid IN (SELECT rowid FROM items WHERE tenant = ? AND provider = ? AND updated_at < ?)',
+            (tenant, provider, loaded_before)
+        )
+        connection.execute('DELETE FROM items WHERE tenant = ? AND provider = ? AND updated_at < ?', (tenant, provider, loaded_before))
+
+def _delete_items(tenant: str, provider: str, item_keys: list):
+    connection = _connect()
+    with _lock, connection:
+        for item_key in item_keys:
+            row = connection.execute(
+                'DELETE FROM items WHERE tenant = ? AND provider = ? AND item_key = ? RETURNING rowid',
+                (tenant, provider, item_key)
+            ).fetchone()
+            if row:
+                connection.execute('DELETE FROM items_fts WHERE rowid = ?', (row[0],))
+
+def _match_expression(tenant: str, query: str, prefix: bool):
+    terms = re.findall(r'\w+', query)
+    if not terms:
+        return None
+    suffix = '*' if prefix else ''
+    return f'tenant : "{tenant}" AND ' + ' AND '.join(f'{{name content}} : "{term}"{suffix}' for term in terms)
+
+def _search(tenant: str, provider: str, query: str, prefix: bool, limit: int):
+    expression = _match_expression(tenant, query, prefix)
+    if expression is None:
+        return []
+    connection = _connect()
+    with _lock:
+        return [row[0] for row in connection.execute(
+            'SELECT items.data FROM items_fts JOIN items ON items.rowid = items_fts.rowid '
+            'WHERE items_fts MATCH ? AND items.provider = ? ORDER BY bm25(items_fts, 0.0, 10.0, 1.0) LIMIT ?',
+            (expression, provider, limit)
+        )]
+
+async def _run_write(function, *args):
+    # The store is a secondary copy: failing to write it must not fail the load
+    try:
+        await asyncio.to_thread(function, *args)
+        return True
+    except sqlite3.Error as e:
+        logger.warning('Item store write failed: %s', e)
+        return False
+
+async def _iter_stored_items(provider: str, credentials, items, prune: bool):
+    tenant = credential_identity(credentials)
+    started_at = time.time()
+    complete = True
+    batch = []
+    async for item in items:
+        batch.append(item)
+        if len(batch) >= ITEM_STORE_WRITE_BATCH:
+            complete = await _run_write(_write_items, tenant, provider, batch, started_at) and complete
+            batch = []
+        yield item
+    if batch:
+        complete = await _run_write(_write_items, tenant, provider, batch, started_at) and complete
+    if prune and complete:
+        await _run_write(_prune_items, tenant, provider, started_at)
+
+def stored_loader(provider: str, credentials, loader, scope=None):
+    # Wraps a provider loader so that everything it fetches from upstream is upserted
+    # into the store. Projected loads carry partial items and are not stored; only
+    # complete, unfiltered crawls remove items that disappeared upstream.
+    if not ITEM_STORE_PATH or (scope and scope.get('fields')):
+        return loader
+
+    def load(**kwargs):
+        prune = not scope and kwargs.get('modified_since') is None
+        return _iter_stored_items(provider, credentials, loader(**kwargs), prune)
+    return load
+
+async def apply_item_changes(provider: str, credentials, items: list, deleted_keys: list):
+    # Applies pushed changes (webhooks) to the stored items: upserts `items` and
+    # removes the `type:id` keys in `deleted_keys`. Unlike load-time writes, failures
+    # raise: the store is the only place these changes land, so the caller must retry.
+    if not ITEM_STORE_PATH:
+        return
+    tenant = credential_identity(credentials)
+    if items:
+        await asyncio.to_thread(_write_items, tenant, provider, items, time.time())
+    if deleted_keys:
+        await asyncio.to_thread(_delete_items, tenant, provider, deleted_keys)
+
+async def search_items(provider: str, credentials, query: str, prefix: bool = True, limit: int = 20) -> bytes:
+    # Full-text search over names and ITEM_STORE_SEARCH_PROPERTIES of the items
+    # previously loaded with these credentials; returns a JSON list of items
+    if not ITEM_STORE_PATH:
+        raise HTTPException(status_code=404, detail='The item store is disabled.')
+    limit = max(1, min(limit, ITEM_STORE_MAX_RESULTS))
+    try:
+        rows = await asyncio.to_thread(_search, credential_identity(credentials), provider, query, prefix, limit)
+    except sqlite3.Error as e:
+        raise HTTPException(status_code=500, detail=f'Item store error: {str(e)}')
+    return ('[' + ','.join(rows) + ']').encode('utf-8')
+
+def close_item_store():
+    global _connection
+    if _connection is not None:
+        with _lock:
+            _connection.close()
+            _connection = None
@@ -0,0 +1,127 @@
+import asyncio
+import json
+import logging
+import os
+import time
+import uuid
+
+from fastapi import HTTPException
+
+from integrations.integration_item import encode_integration_items
+from redis_client import add_key_value_redis, get_value_redis, iter_channel_redis, publish_redis
+
+logger = logging.getLogger(__name__)
+
+# Total crawls one worker process runs at once, and the share any single provider may take
+SYNC_JOB_MAX_CONCURRENCY = int(os.environ.get('SYNC_JOB_MAX_CONCURRENCY', 8))
+SYNC_JOB_PROVIDER_CONCURRENCY = int(os.environ.get('SYNC_JOB_PROVIDER_CONCURRENCY', 3))
+# How long job status and results are kept in Redis
+SYNC_JOB_TTL = int(os.environ.get('SYNC_JOB_TTL', 3600))
+# Progress is written and published every this many items
+SYNC_JOB_PROGRESS_INTERVAL = int(os.environ.get('SYNC_JOB_PROGRESS_INTERVAL', 500))
+
+TERMINAL_STATUSES = ('completed', 'failed', 'cancelled')
+
+_global_semaphore = asyncio.Semaphore(SYNC_JOB_MAX_CONCURRENCY)
+_provider_semaphores = {}
+_running_jobs = {}
+
+def _status_key(job_id: str):
+    return f'sync_job:{job_id}'
+
+def _result_key(job_id: str):
+    return f'sync_job_result:{job_id}'
+
+def _events_channel(job_id: str):
+    return f'sync_job_events:{job_id}'
+
+async def _write_status(job: dict):
+    message = json.dumps(job)
+    await add_key_value_redis(_status_key(job['job_id']), message, expire=SYNC_JOB_TTL)
+    await publish_redis(_events_channel(job['job_id']), message)
+
+async def _run_job(job: dict, items_factory):
+    provider_semaphore = _provider_semaphores.setdefault(job['provider'], asyncio.Semaphore(SYNC_JOB_PROVIDER_CONCURRENCY))
+    try:
+        async with provider_semaphore, _global_semaphore:
+            job.update(status='running', started_at=time.time())
+            await _write_status(job)
+
+            items = []
+            async for item in items_factory():
+                items.append(item)
+                if len(items) % SYNC_JOB_PROGRESS_INTERVAL == 0:
+                    job['items'] = len(items)
+                    await _write_status(job)
+
+            await add_key_value_redis(_result_key(job['job_id']), encode_integration_items(items).decode('utf-8'), expire=SYNC_JOB_TTL)
+            job.update(status='completed', items=len(items), finished_at=time.time())
+            await _write_status(job)
+    except asyncio.CancelledError:
+        job.update(status='cancelled', finished_at=time.time())
+        await asyncio.shield(_write_status(job))
+        raise
+    except Exception as e:
+        logger.exception('Sync job %s failed', job['job_id'])
+        job.update(
+            status='failed',
+            error=e.detail if isinstance(e, HTTPException) else str(e),
+            finished_at=time.time()
+        )
+        await _write_status(job)
+    finally:
+        _running_jobs.pop(job['job_id'], None)
+
+async def enqueue_sync_job(provider: str, items_factory):
+    # `items_factory` is a zero-argument callable returning the item iterator to crawl.
+    # The job waits for a free provider/process slot and runs in the background.
+    job = {
+        'job_id': uuid.uuid4().hex,
+        'provider': provider,
+        'status': 'queued',
+        'items': 0,
+        'created_at': time.time(),
+    }
+    await _write_status(job)
+    _running_jobs[job['job_id']] = asyncio.create_task(_run_job(job, items_factory))
+    return job
+
+async def get_sync_job(job_id: str):
+    job = await get_value_redis(_status_key(job_id))
+    if not job:
+        raise HTTPException(status_code=404, detail='Job not found.')
+    return json.loads(job)
+
+async def get_sync_job_result(job_id: str):
+    job = await get_sync_job(job_id)
+    if job['status'] != 'completed':
+        raise HTTPException(status_code=409, detail=f"Job is {job['status']}.")
+    result = await get_value_redis(_result_key(job_id))
+    if result is None:
+        raise HTTPException(status_code=404, detail='Job result has expired.')
+    return result
+
+async def iter_sync_job_events(job_id: str):
+    # Yields the current status, then every update until the job finishes
+    job = await get_sync_job(job_id)
+    yield json.dumps(job) + '\n'
+    if job['status'] in TERMINAL_STATUSES:
+        return
+    async for message in iter_channel_redis(_events_channel(job_id)):
+        if message is None:
+            # Nothing published for a while: fall back to the stored status, which
+            # also covers updates published before the subscription was active
+            latest = await get_sync_job(job_id)
+            if latest == job:
+                continue
+            message = json.dumps(latest)
+        job = json.loads(message)
+        yield message + '\n'
+        if job['status'] in TERMINAL_STATUSES:
+            return
+
+async def cancel_sync_jobs():
+    tasks = list(_running_jobs.values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
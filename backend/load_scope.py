@@ -0,0 +1,37 @@
+import json
+
+from fastapi import HTTPException
+
+# Operators of the provider-neutral filter spec; each integration translates
+# them into its own API's filter syntax
+FILTER_OPERATORS = ('eq', 'neq', 'gt', 'gte', 'lt', 'lte', 'contains')
+
+def _parse_filter(condition):
+    if not isinstance(condition, dict) or not isinstance(condition.get('field'), str) or not condition['field']:
+        raise HTTPException(status_code=400, detail='Each filter needs a "field" name')
+    if condition.get('op', 'eq') not in FILTER_OPERATORS:
+        raise HTTPException(status_code=400, detail=f'Unsupported filter operator: {condition.get("op")}')
+    value = condition.get('value')
+    if not isinstance(value, (str, int, float, bool)):
+        raise HTTPException(status_code=400, detail=f'Filter value for {condition["field"]} must be a string, number or boolean')
+    return {'field': condition['field'], 'op': condition.get('op', 'eq'), 'value': value}
+
+def parse_load_scope(fields: str = None, filters: str = None):
+    # `fields` is a comma-separated list of field/property names to fetch and
+    # `filters` a JSON list of {"field", "op", "value"} conditions that must all
+    # match. Returns the keyword arguments for the provider's get_items_*, or
+    # None for an unnarrowed load so that it keeps sharing the default cache entry.
+    scope = {}
+    if fields:
+        scope['fields'] = [field.strip() for field in fields.split(',') if field.strip()]
+    if filters:
+        try:
+            conditions = json.loads(filters)
+        except json.JSONDecodeError:
+            raise HTTPException(status_code=400, detail='Filters must be a JSON list')
+        if isinstance(conditions, dict):
+            conditions = [conditions]
+        if not isinstance(conditions, list):
+            raise HTTPException(status_code=400, detail='Filters must be a JSON list')
+        scope['filters'] = [_parse_filter(condition) for condition in conditions]
+    return {key: value for key, value in scope.items() if value} or None
@@ -1,11 +1,54 @@
-from fastapi import FastAPI, Form, Request
-from fastapi.middleware.cors import CORSMiddleware
+import time
 
-from integrations.airtable import authorize_airtable, get_items_airtable, oauth2callback_airtable, get_airtable_credentials
-from integrations.notion import authorize_notion, get_items_notion, oauth2callback_notion, get_notion_credentials
-from integrations.hubspot import authorize_hubspot, get_hubspot_credentials, get_items_hubspot, oauth2callback_hubspot
+_import_started_at = time.perf_counter()
 
-app = FastAPI()
+from contextlib import asynccontextmanager
+from functools import partial
+
+from fastapi import FastAPI, Form, Request
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import Response, StreamingResponse
+
+from bulk_load import BulkLoadRequest, run_bulk_load
+from coalescing import coalesced_loader
+from delta_sync import iter_delta_items
+from hierarchy import get_hierarchy_index, node_payload, subtree_payload
+from http_clients import close_http_clients, init_http_clients
+from item_cache import iter_cached_items
+from item_store import close_item_store, search_items, stored_loader
+from jobs import cancel_sync_jobs, enqueue_sync_job, get_sync_job, get_sync_job_result, iter_sync_job_events
+from load_scope import parse_load_scope
+from metrics import MetricsMiddleware, metrics_payload
+from pagination import MAX_PAGE_SIZE, load_page
+from providers import PROVIDER_REGISTRY, get_provider, get_provider_handler, import_report, log_import_report, preload_providers
+from redis_client import close_redis, start_local_cache_invalidation
+from request_policy import request_policy_stats
+from responses import JSON_MEDIA_TYPE, NDJSON_MEDIA_TYPE, items_response, wants_stream
+from webhooks import receive_webhook, start_webhook_consumer, subscribe_webhooks
+
+# Integration modules are not imported here: the provider registry loads each
+# one on first use, so unused providers add nothing to worker cold start
+APP_IMPORT_SECONDS = time.perf_counter() - _import_started_at
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # One pooled httpx client per provider, shared by every request for the app's lifetime
+    init_http_clients()
+    preload_providers()
+    log_import_report(APP_IMPORT_SECONDS)
+    invalidation_task = await start_local_cache_invalidation()
+    # Applies queued webhook events to the item store
+    webhook_task = start_webhook_consumer()
+    yield
+    webhook_task.cancel()
+    await cancel_sync_jobs()
+    if invalidation_task:
+        invalidation_task.cancel()
+    await close_http_clients()
+    await close_redis()
+    close_item_store()
+
+app = FastAPI(lifespan=lifespan)
 
 
 origins = [
@@ -20,60 +63,166 @@ app.add_middleware(
     allow_headers=["Content-Type", "Authorization"],
     expose_headers=["Content-Type", "Authorization"],
 )
+app.add_middleware(MetricsMiddleware)
 
 @app.get('/')
 def read_root():
     return {'Ping': 'Pong'}
 
+@app.get('/metrics')
+def get_metrics():
+    payload, content_type = metrics_payload()
+    return Response(content=payload, media_type=content_type)
+
+def load_items(provider: str, credentials: str, get_items, incremental: bool = False, coalesce: bool = True, scope: dict = None, fill_cache: bool = True):
+    # `scope` holds the field projection and filters pushed down to the provider
+    # Everything fetched from upstream is also kept in the local search store
+    loader = stored_loader(provider, credentials, partial(get_items, credentials, **(scope or {})), scope)
+    if incremental:
+        # Delta loads must see the latest changes, so they skip the item cache
+        return iter_delta_items(provider, credentials, loader, scope)
+    if coalesce:
+        # Identical concurrent cache misses share one upstream crawl. Streaming
+        # requests opt out so that they still get items page by page.
+        loader = coalesced_loader(provider, credentials, loader, scope)
+    return iter_cached_items(provider, credentials, loader, scope, fill=fill_cache)
+
+async def load_response(request: Request, provider: str, credentials: str, get_items, incremental: bool, fields: str, filters: str):
+    scope = parse_load_scope(fields, filters)
+    # Streaming requests neither coalesce nor fill the cache, both of which would
+    # hold the whole crawl in memory; a fresh cached copy is still served
+    stream = wants_stream(request)
+    items = load_items(provider, credentials, get_items, incremental, coalesce=not stream, scope=scope, fill_cache=not stream)
+    # Not indexed on the way through: an index holds every item, which would undo
+    # flat-memory streaming; tree and node requests build their own
+    return await items_response(request, items)
+
+def get_item_loader(provider: str):
+    return get_provider_handler(provider, 'get_items')
+
+async def load_hierarchy_index(provider: str, credentials: str, fields: str = None, filters: str = None):
+    scope = parse_load_scope(fields, filters)
+    get_items = get_item_loader(provider)
+    return await get_hierarchy_index(provider, credentials, partial(load_items, provider, credentials, get_items, scope=scope), scope)
+
+
+# Provider routes, generated from the registry
+def add_provider_routes(spec):
+    prefix = f'/integrations/{spec.name}'
+
+    async def authorize_integration(user_id: str = Form(...), org_id: str = Form(...)):
+        return await spec.handler('authorize')(user_id, org_id)
+
+    async def oauth2callback_integration(request: Request):
+        return await spec.handler('oauth2callback')(request)
+
+    async def get_credentials_integration(user_id: str = Form(...), org_id: str = Form(...)):
+        return await spec.handler('credentials')(user_id, org_id)
+
+    async def load_integration(request: Request, credentials: str = Form(...), incremental: bool = Form(False), fields: str = Form(None), filters: str = Form(None)):
+        return await load_response(request, spec.name, credentials, spec.handler('get_items'), incremental, fields, filters)
+
+    app.add_api_route(f'{prefix}/authorize', authorize_integration, methods=['POST'], name=f'authorize_{spec.name}_integration')
+    app.add_api_route(f'{prefix}/oauth2callback', oauth2callback_integration, methods=['GET'], name=f'oauth2callback_{spec.name}_integration')
+    app.add_api_route(f'{prefix}/credentials', get_credentials_integration, methods=['POST'], name=f'get_{spec.name}_credentials_integration')
+    app.add_api_route(f'{prefix}/{spec.load_path}', load_integration, methods=['POST'], name=f'get_{spec.name}_items')
+
+for provider_spec in PROVIDER_REGISTRY.values():
+    add_provider_routes(provider_spec)
+
+@app.get('/providers')
+def get_providers():
+    # Which provider modules this worker has imported so far, and what each cost
+    return import_report()
+
+@app.get('/upstream/stats')
+def get_upstream_stats():
+    # Recent single-attempt vs whole-call read latency per provider, with the
+    # retries and hedges that separate the two
+    return request_policy_stats()
+
+
+# Paginated loads
+@app.post('/integrations/{provider}/load_page')
+async def load_page_integration(provider: str, credentials: str = Form(...), cursor: str = Form(None), page_size: int = Form(MAX_PAGE_SIZE), fields: str = Form(None), filters: str = Form(None)):
+    # One upstream page per call, bypassing the item cache, so the first page
+    # renders without waiting for a full crawl
+    get_items_page = get_provider_handler(provider, 'get_items_page')
+    payload = await load_page(get_items_page, credentials, cursor, page_size, parse_load_scope(fields, filters))
+    return Response(content=payload, media_type=JSON_MEDIA_TYPE)
+
+
+# Item hierarchy
+@app.post('/integrations/{provider}/tree')
+async def get_item_tree_integration(provider: str, credentials: str = Form(...), root_id: str = Form(None), depth: int = Form(None), fields: str = Form(None), filters: str = Form(None)):
+    index = await load_hierarchy_index(provider, credentials, fields, filters)
+    return Response(content=subtree_payload(index, root_id, depth), media_type=JSON_MEDIA_TYPE)
+
+@app.post('/integrations/{provider}/items/{item_id}')
+async def get_item_node_integration(provider: str, item_id: str, credentials: str = Form(...), item_type: str = Form(None), fields: str = Form(None), filters: str = Form(None)):
+    index = await load_hierarchy_index(provider, credentials, fields, filters)
+    return Response(content=node_payload(index, item_id, item_type), media_type=JSON_MEDIA_TYPE)
+
+
+# Search
+@app.post('/integrations/{provider}/search')
+async def search_items_integration(provider: str, credentials: str = Form(...), q: str = Form(...), prefix: bool = Form(True), limit: int = Form(20)):
+    # Answered from the local item store only, so it works while upstream is unavailable
+    get_provider(provider)
+    return Response(content=await search_items(provider, credentials, q, prefix, limit), media_type=JSON_MEDIA_TYPE)
+
+
+# Webhooks
+@app.post('/integrations/{provider}/webhooks')
+async def receive_webhook_integration(provider: str, request: Request):
+    # Verified and queued only; the response must not wait on the provider API
+    return await receive_webhook(provider, request)
+
+@app.post('/integrations/{provider}/webhooks/subscriptions')
+async def subscribe_webhooks_integration(provider: str, credentials: str = Form(...), source_id: str = Form(...)):
+    # `source_id` is the HubSpot portal id, Airtable base id or Notion workspace id
+    # whose events update the items stored for these credentials
+    return await subscribe_webhooks(provider, source_id, credentials)
+
+
+# Background sync jobs
+@app.post('/integrations/{provider}/jobs')
+async def enqueue_sync_job_integration(provider: str, credentials: str = Form(...), incremental: bool = Form(False), fields: str = Form(None), filters: str = Form(None)):
+    get_items = get_item_loader(provider)
+    scope = parse_load_scope(fields, filters)
+    # Not coalesced: a shared crawl is buffered whole, so job progress would jump from 0 to done
+    return await enqueue_sync_job(provider, partial(load_items, provider, credentials, get_items, incremental, coalesce=False, scope=scope))
 
-# Airtable
-@app.post('/integrations/airtable/authorize')
-async def authorize_airtable_integration(user_id: str = Form(...), org_id: str = Form(...)):
-    return await authorize_airtable(user_id, org_id)
-
-@app.get('/integrations/airtable/oauth2callback')
-async def oauth2callback_airtable_integration(request: Request):
-    return await oauth2callback_airtable(request)
-
-@app.post('/integrations/airtable/credentials')
-async def get_airtable_credentials_integration(user_id: str = Form(...), org_id: str = Form(...)):
-    return await get_airtable_credentials(user_id, org_id)
-
-@app.post('/integrations/airtable/load')
-async def get_airtable_items(credentials: str = Form(...)):
-    return await get_items_airtable(credentials)
-
-
-# Notion
-@app.post('/integrations/notion/authorize')
-async def authorize_notion_integration(user_id: str = Form(...), org_id: str = Form(...)):
-    return await authorize_notion(user_id, org_id)
-
-@app.get('/integrations/notion/oauth2callback')
-async def oauth2callback_notion_integration(request: Request):
-    return await oauth2callback_notion(request)
-
-@app.post('/integrations/notion/credentials')
-async def get_notion_credentials_integration(user_id: str = Form(...), org_id: str = Form(...)):
-    return await get_notion_credentials(user_id, org_id)
-
-@app.post('/integrations/notion/load')
-async def get_notion_items(credentials: str = Form(...)):
-    return await get_items_notion(credentials)
-
-# HubSpot
-@app.post('/integrations/hubspot/authorize')
-async def authorize_hubspot_integration(user_id: str = Form(...), org_id: str = Form(...)):
-    return await authorize_hubspot(user_id, org_id)
+@app.get('/jobs/{job_id}')
+async def get_sync_job_integration(job_id: str):
+    return await get_sync_job(job_id)
 
-@app.get('/integrations/hubspot/oauth2callback')
-async def oauth2callback_hubspot_integration(request: Request):
-    return await oauth2callback_hubspot(request)
+@app.get('/jobs/{job_id}/result')
+async def get_sync_job_result_integration(job_id: str):
+    return Response(content=await get_sync_job_result(job_id), media_type=JSON_MEDIA_TYPE)
 
-@app.post('/integrations/hubspot/credentials')
-async def get_hubspot_credentials_integration(user_id: str = Form(...), org_id: str = Form(...)):
-    return await get_hubspot_credentials(user_id, org_id)
+@app.get('/jobs/{job_id}/events')
+async def get_sync_job_events_integration(job_id: str):
+    events = iter_sync_job_events(job_id)
+    # Resolve the first event up front so an unknown job id is a 404, not an empty stream
+    first_event = await events.__anext__()
+
+    async def stream():
+        yield first_event
+        async for event in events:
+            yield event
 
-@app.post('/integrations/hubspot/get_hubspot_items')
-async def load_slack_data_integration(credentials: str = Form(...)):
-    return await get_items_hubspot(credentials)
+    return StreamingResponse(stream(), media_type=NDJSON_MEDIA_TYPE)
+
+
+# Bulk loads
+@app.post('/integrations/bulk_load')
+async def bulk_load_integrations(bulk_load: BulkLoadRequest):
+    for tenant in bulk_load.tenants:
+        get_provider(tenant.provider)
+
+    def items_factory(provider: str, credentials: str):
+        # Not coalesced, so each tenant's scheduler slot covers one upstream page rather than a whole crawl
+        return load_items(provider, credentials, get_item_loader(provider), bulk_load.incremental, coalesce=False)
+
+    return await run_bulk_load(bulk_load.tenants, items_factory, bulk_load.include_items)
@@ -0,0 +1,159 @@
+import contextvars
+import functools
+import inspect
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager
+
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Histogram, generate_latest
+from prometheus_client import multiprocess
+
+logger = logging.getLogger(__name__)
+
+# Per-request timing breakdowns are only produced when enabled here and asked
+# for by the client with an `X-Profile: 1` request header
+REQUEST_PROFILING_ENABLED = os.environ.get('REQUEST_PROFILING_ENABLED', '').lower() in ('1', 'true', 'yes')
+PROFILE_HEADER = b'x-profile'
+
+UPSTREAM_REQUESTS = Counter(
+    'upstream_requests_total',
+    'Requests sent to provider APIs',
+    ['provider', 'method', 'status'],
+)
+UPSTREAM_LATENCY = Histogram(
+    'upstream_request_duration_seconds',
+    'Provider API request latency',
+    ['provider', 'method'],
+    buckets=(0.025, 0.05, 0.1, 0.2, 0.4, 0.8, 1.6, 3.2, 6.4, 12.8, 30.0),
+)
+UPSTREAM_CALL_LATENCY = Histogram(
+    'upstream_call_duration_seconds',
+    'Provider API read latency as seen by callers, including retries and hedges',
+    ['provider', 'method'],
+    buckets=(0.025, 0.05, 0.1, 0.2, 0.4, 0.8, 1.6, 3.2, 6.4, 12.8, 30.0),
+)
+UPSTREAM_POLICY_EVENTS = Counter(
+    'upstream_policy_events_total',
+    'Retries, attempt timeouts and hedged requests for provider API reads',
+    ['provider', 'event'],
+)
+REDIS_LATENCY = Histogram(
+    'redis_operation_duration_seconds',
+    'Redis operation latency',
+    ['operation'],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0),
+)
+ROUTE_LATENCY = Histogram(
+    'http_route_duration_seconds',
+    'End-to-end route latency, including streamed bodies',
+    ['method', 'route', 'status'],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0),
+)
+
+def metrics_payload():
+    # With several workers, PROMETHEUS_MULTIPROC_DIR makes every process write its
+    # samples there and /metrics aggregates them
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(), CONTENT_TYPE_LATEST
+
+# Request profiling
+
+_profile = contextvars.ContextVar('request_profile', default=None)
+
+def record_profile(section: str, seconds: float):
+    profile = _profile.get()
+    if profile is not None:
+        profile[section] = profile.get(section, 0.0) + seconds
+
+@contextmanager
+def profile_section(section: str):
+    if _profile.get() is None:
+        yield
+        return
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_profile(section, time.perf_counter() - started_at)
+
+def profiled(section: str):
+    # Decorator for sync or async functions whose time should count towards `section`.
+    # These wrap per-item hot paths, so an unprofiled call costs one context var lookup.
+    def decorator(function):
+        if inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def async_wrapper(*args, **kwargs):
+                profile = _profile.get()
+                if profile is None:
+                    return await function(*args, **kwargs)
+                started_at = time.perf_counter()
+                try:
+                    return await function(*args, **kwargs)
+                finally:
+                    profile[section] = profile.get(section, 0.0) + time.perf_counter() - started_at
+            return async_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            profile = _profile.get()
+            if profile is None:
+                return function(*args, **kwargs)
+            started_at = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                profile[section] = profile.get(section, 0.0) + time.perf_counter() - started_at
+        return wrapper
+    return decorator
+
+def parse_json(response):
+    with profile_section('json_parse'):
+        return response.json()
+
+def _server_timing(profile: dict):
+    return ', '.join(f'{section};dur={seconds * 1000:.1f}' for section, seconds in profile.items())
+
+class MetricsMiddleware:
+    # Pure ASGI middleware so streamed responses are timed until their last chunk
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        started_at = time.perf_counter()
+        status = {'code': 500}
+        profile = None
+        token = None
+        if REQUEST_PROFILING_ENABLED and dict(scope.get('headers', ())).get(PROFILE_HEADER) == b'1':
+            profile = {}
+            token = _profile.set(profile)
+
+        async def send_wrapper(message):
+            if message['type'] == 'http.response.start':
+                status['code'] = message['status']
+                if profile is not None:
+                    # Complete for buffered responses; streamed ones are logged in full below
+                    message = {**message, 'headers': [*message.get('headers', []), (b'server-timing', _server_timing(profile).encode('latin-1'))]}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            seconds = time.perf_counter() - started_at
+            route = scope.get('route')
+            route_name = getattr(route, 'path', None) or getattr(scope.get('endpoint'), '__name__', 'unmatched')
+            ROUTE_LATENCY.labels(scope['method'], route_name, str(status['code'])).observe(seconds)
+            if profile is not None:
+                _profile.reset(token)
+                logger.info('Request profile %s %s: %s', scope['method'], scope['path'], json.dumps({
+                    'total_ms': round(seconds * 1000, 1),
+                    **{f'{section}_ms': round(value * 1000, 1) for section, value in profile.items()},
+                }))
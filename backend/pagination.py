@@ -0,0 +1,54 @@
+import base64
+import binascii
+import json
+
+from fastapi import HTTPException
+
+from integrations.integration_item import encode_integration_items
+
+# Every provider caps its upstream page at 100 items
+MAX_PAGE_SIZE = 100
+
+def encode_cursor(position: dict):
+    # Cursors are opaque to clients: url-safe base64 of the provider position
+    if position is None:
+        return None
+    return base64.urlsafe_b64encode(json.dumps(position, separators=(',', ':')).encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor: str):
+    if not cursor:
+        return None
+    try:
+        position = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (binascii.Error, UnicodeError, ValueError):
+        raise HTTPException(status_code=400, detail='Invalid cursor')
+    if not isinstance(position, dict):
+        raise HTTPException(status_code=400, detail='Invalid cursor')
+    return position
+
+def _cursor_value_valid(value, expected):
+    if isinstance(expected, list):
+        # [kind]: a list whose elements are all `kind`
+        return isinstance(value, list) and all(_cursor_value_valid(element, expected[0]) for element in value)
+    if isinstance(value, bool) or not isinstance(value, expected):
+        return False
+    # Ints in cursors are indices and counts; a negative one would index from the end
+    return not isinstance(value, int) or value >= 0
+
+def check_cursor(position: dict, required: dict, optional: dict = None):
+    # Providers declare the keys (and their types) a cursor of theirs carries, so that
+    # a well-formed but foreign or tampered cursor is a 400 rather than a KeyError
+    optional = optional or {}
+    if not set(required) <= set(position) <= set(required) | set(optional):
+        raise HTTPException(status_code=400, detail='Invalid cursor')
+    for key, value in position.items():
+        if not _cursor_value_valid(value, required.get(key) or optional[key]):
+            raise HTTPException(status_code=400, detail='Invalid cursor')
+
+async def load_page(get_items_page, credentials: str, cursor: str = None, page_size: int = MAX_PAGE_SIZE, scope: dict = None) -> bytes:
+    # Runs exactly one upstream page request and returns
+    # {"items": [...], "next_cursor": "..." | null}
+    if page_size < 1:
+        raise HTTPException(status_code=400, detail='page_size must be positive')
+    items, position = await get_items_page(credentials, decode_cursor(cursor), min(page_size, MAX_PAGE_SIZE), **(scope or {}))
+    return b'{"items":%s,"next_cursor":%s}' % (encode_integration_items(items), json.dumps(encode_cursor(position)).encode('utf-8'))
@@ -0,0 +1,109 @@
+import importlib
+import logging
+import os
+import sys
+import time
+
+from fastapi import HTTPException
+
+logger = logging.getLogger(__name__)
+
+# Providers imported at startup instead of on first use, e.g. 'airtable,notion'
+# or 'all', for workers that would rather pay the import cost before serving
+PROVIDER_PRELOAD = os.environ.get('PROVIDER_PRELOAD', '')
+
+class ProviderSpec:
+    # Where a provider's handlers live. The module is imported on the first
+    # request that needs one of them, so unused providers cost nothing at startup.
+    __slots__ = ('name', 'module_name', 'handlers', 'load_path', '_module', 'import_seconds')
+
+    def __init__(self, name: str, module_name: str, handlers: dict, load_path: str = 'load'):
+        self.name = name
+        self.module_name = module_name
+        # Role -> function name in the module: authorize, oauth2callback,
+        # credentials, get_items, get_items_page, parse_webhook and apply_webhook_events
+        self.handlers = handlers
+        self.load_path = load_path
+        self._module = None
+        self.import_seconds = None
+
+    @property
+    def loaded(self):
+        return self._module is not None
+
+    def module(self):
+        if self._module is None:
+            already_imported = self.module_name in sys.modules
+            started_at = time.perf_counter()
+            self._module = importlib.import_module(self.module_name)
+            if not already_imported:
+                self.import_seconds = time.perf_counter() - started_at
+                logger.info('Imported provider %s in %.1f ms', self.name, self.import_seconds * 1000)
+        return self._module
+
+    def handler(self, role: str):
+        return getattr(self.module(), self.handlers[role])
+
+PROVIDER_REGISTRY = {
+    'airtable': ProviderSpec('airtable', 'integrations.airtable', {
+        'authorize': 'authorize_airtable',
+        'oauth2callback': 'oauth2callback_airtable',
+        'credentials': 'get_airtable_credentials',
+        'get_items': 'get_items_airtable',
+        'get_items_page': 'get_items_page_airtable',
+        'parse_webhook': 'parse_webhook_airtable',
+        'apply_webhook_events': 'apply_webhook_events_airtable',
+    }),
+    'notion': ProviderSpec('notion', 'integrations.notion', {
+        'authorize': 'authorize_notion',
+        'oauth2callback': 'oauth2callback_notion',
+        'credentials': 'get_notion_credentials',
+        'get_items': 'get_items_notion',
+        'get_items_page': 'get_items_page_notion',
+        'parse_webhook': 'parse_webhook_notion',
+        'apply_webhook_events': 'apply_webhook_events_notion',
+    }),
+    'hubspot': ProviderSpec('hubspot', 'integrations.hubspot', {
+        'authorize': 'authorize_hubspot',
+        'oauth2callback': 'oauth2callback_hubspot',
+        'credentials': 'get_hubspot_credentials',
+        'get_items': 'get_items_hubspot',
+        'get_items_page': 'get_items_page_hubspot',
+        'parse_webhook': 'parse_webhook_hubspot',
+        'apply_webhook_events': 'apply_webhook_events_hubspot',
+    }, load_path='get_hubspot_items'),
+}
+
+def get_provider(provider: str):
+    spec = PROVIDER_REGISTRY.get(provider)
+    if spec is None:
+        raise HTTPException(status_code=404, detail=f'Unknown provider: {provider}')
+    return spec
+
+def get_provider_handler(provider: str, role: str):
+    return get_provider(provider).handler(role)
+
+def preload_providers(names: str = PROVIDER_PRELOAD):
+    selected = PROVIDER_REGISTRY if names.strip() == 'all' else [name.strip() for name in names.split(',') if name.strip()]
+    for name in selected:
+        get_provider(name).module()
+
+def import_report():
+    return [
+        {
+            'provider': spec.name,
+            'module': spec.module_name,
+            'loaded': spec.loaded,
+            'import_ms': None if spec.import_seconds is None else round(spec.import_seconds * 1000, 1),
+        }
+        for spec in PROVIDER_REGISTRY.values()
+    ]
+
+def log_import_report(app_import_seconds: float = None):
+    if app_import_seconds is not None:
+        logger.info('App modules imported in %.1f ms', app_import_seconds * 1000)
+    for entry in import_report():
+        if entry['loaded']:
+            logger.info('Provider %s: loaded, import took %s ms', entry['provider'], entry['import_ms'])
+        else:
+            logger.info('Provider %s: deferred until first use', entry['provider'])
@@ -0,0 +1,112 @@
+import asyncio
+import hashlib
+import os
+import random
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+from redis_client import eval_script_redis
+
+# (bucket capacity, refill period in seconds) per provider:
+# Airtable 5 req/s per base, Notion ~3 req/s, HubSpot 100 per 10s
+PROVIDER_RATE_LIMITS = {
+    'airtable': (5, 1.0),
+    'notion': (3, 1.0),
+    'hubspot': (100, 10.0),
+}
+
+RATE_LIMIT_MAX_RETRIES = int(os.environ.get('RATE_LIMIT_MAX_RETRIES', 5))
+RATE_LIMIT_BACKOFF_BASE = float(os.environ.get('RATE_LIMIT_BACKOFF_BASE', 1.0))
+RATE_LIMIT_BACKOFF_MAX = float(os.environ.get('RATE_LIMIT_BACKOFF_MAX', 60.0))
+
+# Returns 0 when a token was taken, otherwise the number of milliseconds to wait.
+# A block key set after a 429 pauses every worker sharing the bucket until it expires.
+TOKEN_BUCKET_SCRIPT = """
+local block_ttl = redis.call('PTTL', KEYS[2])
+if block_ttl > 0 then
+    return block_ttl
+end
+
+local capacity = tonumber(ARGV[1])
+local refill_per_ms = tonumber(ARGV[2])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or capacity
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * refill_per_ms)
+
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = math.ceil((1 - tokens) / refill_per_ms)
+end
+
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(capacity / refill_per_ms) * 2)
+return wait
+"""
+
+BLOCK_SCRIPT = """
+local current = redis.call('PTTL', KEYS[1])
+if current < tonumber(ARGV[1]) then
+    redis.call('SET', KEYS[1], '1', 'PX', ARGV[1])
+end
+return 1
+"""
+
+def credential_key(secret: str):
+    # Never put the token itself into a Redis key
+    return hashlib.sha256((secret or '').encode('utf-8')).hexdigest()[:16]
+
+def _bucket_keys(provider: str, rate_key: str):
+    return [f'rate_limit:{provider}:{rate_key}', f'rate_limit_block:{provider}:{rate_key}']
+
+async def acquire(provider: str, rate_key: str):
+    capacity, period = PROVIDER_RATE_LIMITS[provider]
+    while True:
+        wait_ms = await eval_script_redis(
+            TOKEN_BUCKET_SCRIPT,
+            _bucket_keys(provider, rate_key),
+            [capacity, capacity / (period * 1000)]
+        )
+        if not wait_ms or int(wait_ms) <= 0:
+            return
+        await asyncio.sleep(int(wait_ms) / 1000)
+
+async def try_acquire(provider: str, rate_key: str):
+    # Takes a token only if one is available right now, e.g. for optional hedged requests
+    capacity, period = PROVIDER_RATE_LIMITS[provider]
+    wait_ms = await eval_script_redis(
+        TOKEN_BUCKET_SCRIPT,
+        _bucket_keys(provider, rate_key),
+        [capacity, capacity / (period * 1000)]
+    )
+    return not wait_ms or int(wait_ms) <= 0
+
+async def block(provider: str, rate_key: str, seconds: float):
+    await eval_script_redis(
+        BLOCK_SCRIPT,
+        _bucket_keys(provider, rate_key)[1:],
+        [max(1, int(seconds * 1000))]
+    )
+
+def retry_after_seconds(response):
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+def backoff_seconds(attempt: int, base: float = RATE_LIMIT_BACKOFF_BASE, maximum: float = RATE_LIMIT_BACKOFF_MAX):
+    # Full jitter exponential backoff
+    return random.uniform(0, min(maximum, base * (2 ** attempt)))
@@ -1,56 +1,274 @@
+import asyncio
+import logging
 import os
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+
 import redis.asyncio as redis
-from kombu.utils.url import safequote
 from fastapi import HTTPException
-from redis.exceptions import ConnectionError, RedisError
+from redis.exceptions import ConnectionError, RedisError, ResponseError
+
+from metrics import REDIS_LATENCY, profile_section
+
+logger = logging.getLogger(__name__)
 
 REDIS_HOST = os.environ.get('REDIS_HOST', 'localhost')
-REDIS_PORT = int(os.environ.get('REDIS_PORT', 6380))  
+REDIS_PORT = int(os.environ.get('REDIS_PORT', 6380))
 REDIS_DB = int(os.environ.get('REDIS_DB', 0))
+REDIS_MAX_CONNECTIONS = int(os.environ.get('REDIS_MAX_CONNECTIONS', 50))
 
-redis_client = redis.Redis(
+# In-process LRU for hot credential reads; size 0 disables it. Entries are dropped
+# on our own writes, on keyspace notifications from other workers, and after the TTL
+# as a fallback when the server does not publish notifications.
+REDIS_LOCAL_CACHE_SIZE = int(os.environ.get('REDIS_LOCAL_CACHE_SIZE', 256))
+REDIS_LOCAL_CACHE_TTL = float(os.environ.get('REDIS_LOCAL_CACHE_TTL', 30))
+# Set to enable keyspace events on the server at startup (needs CONFIG permission)
+REDIS_CONFIGURE_KEYSPACE_EVENTS = os.environ.get('REDIS_CONFIGURE_KEYSPACE_EVENTS', '').lower() in ('1', 'true', 'yes')
+LOCAL_CACHE_KEY_PATTERNS = ('*_credentials:*',)
+
+redis_pool = redis.ConnectionPool(
     host=REDIS_HOST,
     port=REDIS_PORT,
     db=REDIS_DB,
-    decode_responses=True,  
-    socket_timeout=5,      
-    socket_connect_timeout=5
+    decode_responses=True,
+    socket_timeout=5,
+    socket_connect_timeout=5,
+    max_connections=REDIS_MAX_CONNECTIONS,
 )
 
-async def add_key_value_redis(key: str, value: str, expire: int = None):
+redis_client = redis.Redis(connection_pool=redis_pool)
+
+class LocalCache:
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+
+    def get(self, key: str):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key: str, value):
+        if self.maxsize <= 0 or value is None:
+            return
+        self._entries[key] = (value, time.monotonic() + self.ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, *keys: str):
+        for key in keys:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+local_cache = LocalCache(REDIS_LOCAL_CACHE_SIZE, REDIS_LOCAL_CACHE_TTL)
+
+@asynccontextmanager
+async def _redis_errors(action: str, operation: str):
+    # Maps Redis failures to HTTP 500s and records the operation's latency
+    started_at = time.perf_counter()
     try:
-        async with redis_client.client() as client:
-            await client.set(key, value)
-            if expire:
-                await client.expire(key, expire)
-            return True
+        with profile_section('redis'):
+            yield
+    except HTTPException:
+        raise
     except ConnectionError as e:
         raise HTTPException(status_code=500, detail=f"Redis connection error: {str(e)}")
     except RedisError as e:
         raise HTTPException(status_code=500, detail=f"Redis error: {str(e)}")
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error adding to Redis: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error {action} Redis: {str(e)}")
+    finally:
+        REDIS_LATENCY.labels(operation).observe(time.perf_counter() - started_at)
 
-async def get_value_redis(key: str):
-    try:
-        async with redis_client.client() as client:
-            value = await client.get(key)
+async def add_key_value_redis(key: str, value: str, expire: int = None):
+    async with _redis_errors('adding to', 'set'):
+        # SET with EX is a single atomic round trip
+        await redis_client.set(key, value, ex=expire)
+        local_cache.invalidate(key)
+        return True
+
+async def add_key_value_if_absent_redis(key: str, value: str, expire: int = None):
+    # Returns True only when this call created the key (SET NX), e.g. to take a lock
+    async with _redis_errors('adding to', 'set_nx'):
+        return bool(await redis_client.set(key, value, ex=expire, nx=True))
+
+async def add_key_values_redis(mapping: dict, expire: int = None, delete: tuple = ()):
+    # Pipelined multi-set, plus deletes of `delete` keys (e.g. a consumed OAuth
+    # state): one round trip for any number of keys
+    async with _redis_errors('adding to', 'pipeline_set'):
+        async with redis_client.pipeline(transaction=False) as pipe:
+            for key, value in mapping.items():
+                pipe.set(key, value, ex=expire)
+            if delete:
+                pipe.delete(*delete)
+            await pipe.execute()
+        local_cache.invalidate(*mapping, *delete)
+        return True
+
+async def get_value_redis(key: str, use_local_cache: bool = False):
+    if use_local_cache:
+        value = local_cache.get(key)
+        if value is not None:
             return value
-    except ConnectionError as e:
-        raise HTTPException(status_code=500, detail=f"Redis connection error: {str(e)}")
-    except RedisError as e:
-        raise HTTPException(status_code=500, detail=f"Redis error: {str(e)}")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error getting from Redis: {str(e)}")
+    async with _redis_errors('getting from', 'get'):
+        value = await redis_client.get(key)
+    if use_local_cache:
+        local_cache.set(key, value)
+    return value
+
+async def get_values_redis(keys: list):
+    # Multi-get in one round trip; returns values in the order of `keys` (None if missing)
+    if not keys:
+        return []
+    async with _redis_errors('getting from', 'mget'):
+        return await redis_client.mget(keys)
 
 async def delete_key_redis(key: str):
+    async with _redis_errors('deleting from', 'delete'):
+        await redis_client.delete(key)
+        local_cache.invalidate(key)
+        return True
+
+async def get_hash_redis(key: str):
+    async with _redis_errors('getting from', 'hgetall'):
+        return await redis_client.hgetall(key)
+
+async def add_hash_values_redis(key: str, mapping: dict, expire: int = None):
+    async with _redis_errors('adding to', 'pipeline_hset'):
+        async with redis_client.pipeline(transaction=True) as pipe:
+            pipe.hset(key, mapping=mapping)
+            if expire:
+                pipe.expire(key, expire)
+            await pipe.execute()
+        return True
+
+async def publish_redis(channel: str, message: str):
+    async with _redis_errors('publishing to', 'publish'):
+        return await redis_client.publish(channel, message)
+
+async def iter_channel_redis(channel: str, idle_timeout: float = 5.0):
+    # Yields messages published on `channel` until the consumer stops iterating.
+    # Yields None whenever nothing arrived for `idle_timeout` seconds, so callers
+    # can re-check state they might have missed before subscribing.
+    pubsub = redis_client.pubsub()
     try:
-        async with redis_client.client() as client:
-            await client.delete(key)
-            return True
-    except ConnectionError as e:
-        raise HTTPException(status_code=500, detail=f"Redis connection error: {str(e)}")
-    except RedisError as e:
-        raise HTTPException(status_code=500, detail=f"Redis error: {str(e)}")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error deleting from Redis: {str(e)}")
+        async with _redis_errors('subscribing to', 'subscribe'):
+            await pubsub.subscribe(channel)
+        while True:
+            async with _redis_errors('reading from', 'get_message'):
+                message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=idle_timeout)
+            yield message['data'] if message else None
+    finally:
+        await pubsub.reset()
+
+async def add_stream_entries_redis(stream: str, entries: list, maxlen: int = None):
+    # Appends every entry (a dict of fields) in one pipelined round trip; the
+    # stream is trimmed to roughly `maxlen` entries
+    if not entries:
+        return []
+    async with _redis_errors('adding to', 'pipeline_xadd'):
+        async with redis_client.pipeline(transaction=False) as pipe:
+            for fields in entries:
+                pipe.xadd(stream, fields, maxlen=maxlen, approximate=True)
+            return await pipe.execute()
+
+async def create_stream_group_redis(stream: str, group: str):
+    # Creates the consumer group (and the stream) unless it already exists
+    async with _redis_errors('creating group on', 'xgroup_create'):
+        try:
+            await redis_client.xgroup_create(stream, group, id='0', mkstream=True)
+        except ResponseError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+        return True
+
+async def read_stream_group_redis(stream: str, group: str, consumer: str, count: int, block_ms: int = None):
+    # Returns [(entry id, fields)] newly delivered to `consumer`
+    async with _redis_errors('reading from', 'xreadgroup'):
+        response = await redis_client.xreadgroup(group, consumer, {stream: '>'}, count=count, block=block_ms)
+    return response[0][1] if response else []
+
+async def claim_stream_entries_redis(stream: str, group: str, consumer: str, min_idle_ms: int, count: int, start: str = '0-0'):
+    # Moves entries that any consumer of the group has left unacknowledged for
+    # `min_idle_ms` to `consumer` (XAUTOCLAIM). Returns the id to continue from
+    # ('0-0' once the whole pending list was scanned) and [(entry id, fields)];
+    # entries trimmed from the stream meanwhile come back with empty fields.
+    async with _redis_errors('claiming from', 'xautoclaim'):
+        response = await redis_client.xautoclaim(stream, group, consumer, min_idle_ms, start, count=count)
+    return response[0], [(entry_id, fields or {}) for entry_id, fields in response[1]]
+
+async def ack_stream_entries_redis(stream: str, group: str, entry_ids: list):
+    if not entry_ids:
+        return 0
+    async with _redis_errors('acknowledging on', 'xack'):
+        return await redis_client.xack(stream, group, *entry_ids)
+
+_registered_scripts = {}
+
+async def eval_script_redis(script: str, keys: list, args: list):
+    # Scripts are registered once and then invoked by SHA (EVALSHA)
+    async with _redis_errors('running script on', 'evalsha'):
+        registered_script = _registered_scripts.get(script)
+        if registered_script is None:
+            registered_script = _registered_scripts[script] = redis_client.register_script(script)
+        return await registered_script(keys=keys, args=args)
+
+DELETE_IF_VALUE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+async def delete_key_if_value_redis(key: str, value: str):
+    # Compare-and-delete, e.g. to release a lock only while this caller still holds it
+    return bool(await eval_script_redis(DELETE_IF_VALUE_SCRIPT, [key], [value]))
+
+async def _listen_for_invalidations():
+    prefix = f'__keyspace@{REDIS_DB}__:'
+    pubsub = redis_client.pubsub()
+    try:
+        await pubsub.psubscribe(*(f'{prefix}{pattern}' for pattern in LOCAL_CACHE_KEY_PATTERNS))
+        async for message in pubsub.listen():
+            if message.get('type') == 'pmessage':
+                local_cache.invalidate(message['channel'][len(prefix):])
+    finally:
+        await pubsub.reset()
+
+async def _run_invalidation_listener():
+    # Keeps the subscription alive across Redis restarts; while it is down the
+    # local cache is cleared so nothing outlives a missed notification
+    while True:
+        try:
+            await _listen_for_invalidations()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning('Redis keyspace listener disconnected: %s', e)
+            local_cache.clear()
+            await asyncio.sleep(1)
+
+async def start_local_cache_invalidation():
+    if local_cache.maxsize <= 0:
+        return None
+    if REDIS_CONFIGURE_KEYSPACE_EVENTS:
+        try:
+            # K: keyspace channel, g: DEL/EXPIRE..., $: string commands, x: expirations
+            await redis_client.config_set('notify-keyspace-events', 'Kg$x')
+        except RedisError as e:
+            logger.warning('Could not enable Redis keyspace events: %s', e)
+    return asyncio.create_task(_run_invalidation_listener())
+
+async def close_redis():
+    await redis_pool.disconnect()
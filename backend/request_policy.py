@@ -0,0 +1,105 @@
+import os
+from collections import deque
+
+from http_clients import provider_setting
+from metrics import UPSTREAM_CALL_LATENCY, UPSTREAM_POLICY_EVENTS
+
+# How idempotent upstream reads are sent. Each value can be overridden globally
+# (e.g. UPSTREAM_MAX_RETRIES) or per provider (e.g. NOTION_UPSTREAM_MAX_RETRIES).
+DEFAULT_REQUEST_POLICY = {
+    # Deadline for one attempt, hedge included; the pool's own timeouts still apply
+    'attempt_timeout': 10.0,
+    # Extra attempts after a 5xx, a connection error or an attempt timeout
+    'max_retries': 3,
+    'retry_backoff_base': 0.2,
+    'retry_backoff_max': 5.0,
+    # A duplicate request is sent once an attempt is slower than this percentile
+    # of recent attempts; 0 disables hedging
+    'hedge_percentile': 95.0,
+    # Hedging waits until this many attempt latencies have been observed
+    'hedge_min_samples': 20,
+}
+
+# Recent latencies kept per provider for hedge delays and /upstream/stats
+LATENCY_WINDOW_SIZE = int(os.environ.get('UPSTREAM_LATENCY_WINDOW_SIZE', 1000))
+STATS_PERCENTILES = (50.0, 90.0, 99.0)
+# `hedges_skipped`: an attempt was slow enough to hedge but the rate budget had no token to spare
+POLICY_EVENTS = ('retries', 'timeouts', 'hedges', 'hedges_won', 'hedges_skipped')
+
+class LatencyWindow:
+    # The most recent latencies, in seconds, with nearest-rank percentiles
+    __slots__ = ('_samples',)
+
+    def __init__(self, size: int = LATENCY_WINDOW_SIZE):
+        self._samples = deque(maxlen=size)
+
+    def __len__(self):
+        return len(self._samples)
+
+    def add(self, seconds: float):
+        self._samples.append(seconds)
+
+    def percentile(self, percentile: float):
+        if not self._samples:
+            return None
+        ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, max(0, int(len(ordered) * percentile / 100.0 + 0.5) - 1))]
+
+class RequestPolicy:
+    __slots__ = (
+        'provider', 'attempt_timeout', 'max_retries', 'retry_backoff_base', 'retry_backoff_max',
+        'hedge_percentile', 'hedge_min_samples', 'attempt_latencies', 'call_latencies', 'counts',
+    )
+
+    def __init__(self, provider: str):
+        self.provider = provider
+        for name in DEFAULT_REQUEST_POLICY:
+            setattr(self, name, provider_setting(provider, name, DEFAULT_REQUEST_POLICY, 'UPSTREAM'))
+        # Single attempts as the provider served them, and whole calls as callers
+        # saw them after retries and hedges; the gap between the two tails is what
+        # the policy buys
+        self.attempt_latencies = LatencyWindow()
+        self.call_latencies = LatencyWindow()
+        self.counts = {'calls': 0, **{event: 0 for event in POLICY_EVENTS}}
+
+    def record(self, event: str):
+        self.counts[event] += 1
+        UPSTREAM_POLICY_EVENTS.labels(self.provider, event).inc()
+
+    def record_call(self, method: str, seconds: float):
+        self.counts['calls'] += 1
+        self.call_latencies.add(seconds)
+        UPSTREAM_CALL_LATENCY.labels(self.provider, method).observe(seconds)
+
+    def hedge_delay(self):
+        # Seconds to wait for an attempt before hedging it, or None when not hedging
+        if not self.hedge_percentile or len(self.attempt_latencies) < self.hedge_min_samples:
+            return None
+        delay = self.attempt_latencies.percentile(self.hedge_percentile)
+        return delay if delay < self.attempt_timeout else None
+
+    def stats(self):
+        return {
+            'provider': self.provider,
+            **self.counts,
+            'attempt_ms': _percentiles_ms(self.attempt_latencies),
+            'call_ms': _percentiles_ms(self.call_latencies),
+        }
+
+def _percentiles_ms(window: LatencyWindow):
+    percentiles = {}
+    for percentile in STATS_PERCENTILES:
+        seconds = window.percentile(percentile)
+        percentiles[f'p{percentile:g}'] = None if seconds is None else round(seconds * 1000, 1)
+    return percentiles
+
+_policies = {}
+
+def get_request_policy(provider: str):
+    policy = _policies.get(provider)
+    if policy is None:
+        policy = _policies[provider] = RequestPolicy(provider)
+    return policy
+
+def request_policy_stats():
+    return [policy.stats() for policy in _policies.values()]
@@ -0,0 +1,161 @@
+import io
+import json
+import os
+
+from fastapi import HTTPException, Request
+from fastapi.responses import Response, StreamingResponse
+
+from integrations.integration_item import IntegrationItem, encode_integration_items
+
+JSON_MEDIA_TYPE = 'application/json'
+NDJSON_MEDIA_TYPE = 'application/x-ndjson'
+MSGPACK_MEDIA_TYPE = 'application/x-msgpack'
+ARROW_STREAM_MEDIA_TYPE = 'application/vnd.apache.arrow.stream'
+
+# Items per Arrow record batch; also how many items are packed per MessagePack chunk
+ITEM_STREAM_BATCH_SIZE = int(os.environ.get('ITEM_STREAM_BATCH_SIZE', 1000))
+# Arrow IPC buffer compression ('zstd', 'lz4' or '' for none); readers decompress transparently
+ARROW_COMPRESSION = os.environ.get('ARROW_COMPRESSION', 'zstd')
+
+async def collect_items(items):
+    return [item async for item in items]
+
+async def _with_first(first_item, items):
+    if first_item is not None:
+        yield first_item
+    async for item in items:
+        yield item
+
+async def _iter_batches(items):
+    batch = []
+    async for item in items:
+        batch.append(item)
+        if len(batch) >= ITEM_STREAM_BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+async def _ndjson_lines(items):
+    async for item in items:
+        yield item.to_json() + b'\n'
+
+async def _msgpack_chunks(items):
+    # A stream of concatenated MessagePack maps, one per item, readable with msgpack.Unpacker
+    import msgpack
+
+    packer = msgpack.Packer(default=str)
+    async for batch in _iter_batches(items):
+        yield b''.join(packer.pack(item.to_dict()) for item in batch)
+
+def _arrow_schema():
+    import pyarrow as pa
+
+    return pa.schema([
+        ('id', pa.string()),
+        ('type', pa.string()),
+        ('directory', pa.bool_()),
+        ('parent_path_or_name', pa.string()),
+        ('parent_id', pa.string()),
+        ('name', pa.string()),
+        ('creation_time', pa.string()),
+        ('last_modified_time', pa.string()),
+        ('url', pa.string()),
+        ('children', pa.list_(pa.string())),
+        ('mime_type', pa.string()),
+        ('delta', pa.string()),
+        ('drive_id', pa.string()),
+        ('visibility', pa.bool_()),
+        # Property shapes differ per provider and per item, so they travel as JSON text
+        ('properties', pa.string()),
+    ])
+
+def _arrow_columns(batch: list, schema):
+    # Providers hand over ints, datetimes and such in string fields, which
+    # from_pydict rejects; every string column (or list of strings) is coerced, nulls kept
+    import pyarrow as pa
+
+    columns = {name: [] for name in IntegrationItem.__slots__}
+    for item in batch:
+        for name, value in item.to_dict().items():
+            columns[name].append(value)
+    columns['properties'] = [
+        None if properties is None else json.dumps(properties, separators=(',', ':'), default=str)
+        for properties in columns['properties']
+    ]
+    for field in schema:
+        if field.type == pa.string():
+            columns[field.name] = [None if value is None else str(value) for value in columns[field.name]]
+        elif field.type == pa.list_(pa.string()):
+            columns[field.name] = [
+                None if values is None else [None if value is None else str(value) for value in values]
+                for values in columns[field.name]
+            ]
+    return columns
+
+async def _arrow_chunks(items):
+    # An Arrow IPC stream: the schema, then one record batch per ITEM_STREAM_BATCH_SIZE items
+    import pyarrow as pa
+
+    schema = _arrow_schema()
+    compression = ARROW_COMPRESSION if ARROW_COMPRESSION and pa.Codec.is_available(ARROW_COMPRESSION) else None
+    sink = io.BytesIO()
+    writer = pa.ipc.new_stream(sink, schema, options=pa.ipc.IpcWriteOptions(compression=compression))
+
+    def drain():
+        chunk = sink.getvalue()
+        sink.seek(0)
+        sink.truncate()
+        return chunk
+
+    yield drain()
+    async for batch in _iter_batches(items):
+        writer.write_batch(pa.RecordBatch.from_pydict(_arrow_columns(batch, schema), schema=schema))
+        yield drain()
+    writer.close()
+    yield drain()
+
+def _module_available(name: str):
+    try:
+        __import__(name)
+    except ImportError:
+        return False
+    return True
+
+# Streamed formats in order of preference, with the optional package each one needs
+ITEM_STREAM_FORMATS = (
+    (ARROW_STREAM_MEDIA_TYPE, _arrow_chunks, 'pyarrow'),
+    (MSGPACK_MEDIA_TYPE, _msgpack_chunks, 'msgpack'),
+    (NDJSON_MEDIA_TYPE, _ndjson_lines, None),
+)
+
+def negotiate_stream_format(request: Request):
+    # Returns (media type, encoder) for a streamed format named in Accept, or None for plain JSON
+    accept = request.headers.get('accept', '')
+    for media_type, encoder, package in ITEM_STREAM_FORMATS:
+        if media_type in accept:
+            if package and not _module_available(package):
+                raise HTTPException(status_code=406, detail=f'{media_type} responses need the {package} package')
+            return media_type, encoder
+    return None
+
+def wants_stream(request: Request):
+    return negotiate_stream_format(request) is not None
+
+async def items_response(request: Request, items):
+    # Clients asking for NDJSON, MessagePack or an Arrow stream get items as soon
+    # as their upstream page arrives; everyone else gets the usual JSON list
+    stream_format = negotiate_stream_format(request)
+    if stream_format is None:
+        # Encoded directly rather than returned as a list, which would send
+        # every item through FastAPI's generic jsonable_encoder
+        return Response(content=encode_integration_items(await collect_items(items)), media_type=JSON_MEDIA_TYPE)
+
+    # Pull the first item before committing to a 200 so that auth/upstream
+    # errors on the first page still surface as a proper HTTP error
+    try:
+        first_item = await items.__anext__()
+    except StopAsyncIteration:
+        first_item = None
+    media_type, encoder = stream_format
+    return StreamingResponse(encoder(_with_first(first_item, items)), media_type=media_type)
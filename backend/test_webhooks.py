@@ -0,0 +1,151 @@
+import asyncio
+import base64
+import json
+import os
+import tempfile
+import time
+
+# Secrets used to sign the test payloads locally; set before the providers are imported
+os.environ.setdefault('CLIENT_SECRET', 'test-hubspot-secret')
+os.environ.setdefault('AIRTABLE_WEBHOOK_SECRET', base64.b64encode(b'test-airtable-secret').decode('ascii'))
+os.environ.setdefault('NOTION_WEBHOOK_SECRET', 'secret_test_notion')
+os.environ.setdefault('ITEM_STORE_PATH', os.path.join(tempfile.mkdtemp(), 'item_store.sqlite3'))
+
+import httpx
+
+import webhooks
+from http_clients import register_http_client
+from integrations.airtable import webhook_signature_airtable
+from integrations.hubspot import webhook_signature_hubspot
+from integrations.integration_item import IntegrationItem
+from integrations.notion import webhook_signature_notion
+from item_store import apply_item_changes
+from main import app
+from redis_client import ack_stream_entries_redis, claim_stream_entries_redis, create_stream_group_redis, delete_key_redis, get_value_redis, read_stream_group_redis
+
+HUBSPOT_CREDENTIALS = json.dumps({'access_token': 'test_access_token', 'expires_at': time.time() + 3600})
+AIRTABLE_CREDENTIALS = json.dumps({'pat': 'test_pat', 'base_id': 'appTest'})
+NOTION_CREDENTIALS = json.dumps({'integration_token': 'test_integration_token'})
+
+def upstream(request: httpx.Request):
+    # What the provider APIs return when the queued events are applied
+    path = request.url.path
+    if path.endswith('/batch/read'):
+        inputs = json.loads(request.content)['inputs']
+        return httpx.Response(200, json={'results': [
+            {'id': entry['id'], 'properties': {'firstname': 'Updated', 'lastname': entry['id'], 'email': f"updated{entry['id']}@example.com"}} for entry in inputs
+        ]})
+    if '/webhooks/' in path:
+        return httpx.Response(200, json={'cursor': 2, 'mightHaveMore': False, 'payloads': [
+            {'changedTablesById': {'tblTest': {'changedRecordsById': {'recChanged': {}}, 'destroyedRecordIds': ['recDestroyed']}}}
+        ]})
+    if path.endswith('/tables'):
+        return httpx.Response(200, json={'tables': [{'id': 'tblTest', 'name': 'Test table', 'fields': []}]})
+    if path.endswith('/tblTest'):
+        return httpx.Response(200, json={'records': [{'id': 'recChanged', 'createdTime': '2024-01-01T00:00:00.000Z', 'fields': {'Name': 'Changed record'}}]})
+    if path.startswith('/v1/pages/'):
+        return httpx.Response(200, json={
+            'object': 'page',
+            'id': path.rsplit('/', 1)[-1],
+            'parent': {'type': 'workspace', 'workspace': True},
+            'created_time': '2024-01-01T00:00:00.000Z',
+            'last_edited_time': '2024-01-01T00:00:00.000Z',
+            'properties': {'title': {'id': 'title', 'type': 'title', 'title': [{'plain_text': 'Renamed page', 'text': {'content': 'Renamed page'}}]}}
+        })
+    return httpx.Response(404)
+
+async def search(client, provider: str, credentials: str, query: str):
+    response = await client.post(f'/integrations/{provider}/search', data={'credentials': credentials, 'q': query})
+    return [item['id'] for item in response.json()]
+
+async def apply_queued_events():
+    # One pass of the webhook consumer
+    entries = await read_stream_group_redis(webhooks.WEBHOOK_STREAM, webhooks.WEBHOOK_GROUP, webhooks.WEBHOOK_CONSUMER, webhooks.WEBHOOK_BATCH_SIZE)
+    acknowledged = await webhooks.apply_webhook_entries(entries)
+    await ack_stream_entries_redis(webhooks.WEBHOOK_STREAM, webhooks.WEBHOOK_GROUP, acknowledged)
+    return len(entries), len(acknowledged)
+
+async def test_webhooks():
+    webhooks.WEBHOOK_STREAM = f'webhook_events:test:{time.time_ns()}'
+    await create_stream_group_redis(webhooks.WEBHOOK_STREAM, webhooks.WEBHOOK_GROUP)
+    await delete_key_redis('webhook_cursor:airtable:achTest')
+    for provider in ('hubspot', 'airtable', 'notion'):
+        register_http_client(provider, httpx.AsyncClient(transport=httpx.MockTransport(upstream)))
+
+    # Items a previous load stored, which the events delete
+    await apply_item_changes('hubspot', HUBSPOT_CREDENTIALS, [IntegrationItem(id='8', type='contact', name='Deleted contact')], [])
+    await apply_item_changes('airtable', AIRTABLE_CREDENTIALS, [IntegrationItem(id='recDestroyed', type='record', name='Destroyed record')], [])
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url='http://testserver') as client:
+        print("\nTesting Subscriptions...")
+        for provider, source_id, credentials in (('hubspot', '42', HUBSPOT_CREDENTIALS), ('airtable', 'appTest', AIRTABLE_CREDENTIALS), ('notion', 'wsTest', NOTION_CREDENTIALS)):
+            response = await client.post(f'/integrations/{provider}/webhooks/subscriptions', data={'source_id': source_id, 'credentials': credentials})
+            assert response.status_code == 200, response.text
+
+        assert await search(client, 'hubspot', HUBSPOT_CREDENTIALS, 'Deleted') == ['8']
+        assert await search(client, 'airtable', AIRTABLE_CREDENTIALS, 'Destroyed') == ['recDestroyed']
+
+        print("\nTesting Signature Verification...")
+        hubspot_body = json.dumps([
+            {'subscriptionType': 'contact.propertyChange', 'portalId': 42, 'objectId': 7},
+            {'subscriptionType': 'contact.deletion', 'portalId': 42, 'objectId': 8},
+        ]).encode('utf-8')
+        timestamp = str(int(time.time() * 1000))
+        signature = webhook_signature_hubspot('POST', 'http://testserver/integrations/hubspot/webhooks', hubspot_body, timestamp)
+        response = await client.post('/integrations/hubspot/webhooks', content=hubspot_body, headers={'X-HubSpot-Signature-v3': 'forged', 'X-HubSpot-Request-Timestamp': timestamp})
+        assert response.status_code == 401
+        stale = str(int(timestamp) - 3600 * 1000)
+        response = await client.post('/integrations/hubspot/webhooks', content=hubspot_body, headers={'X-HubSpot-Signature-v3': webhook_signature_hubspot('POST', 'http://testserver/integrations/hubspot/webhooks', hubspot_body, stale), 'X-HubSpot-Request-Timestamp': stale})
+        assert response.status_code == 401
+        airtable_body = json.dumps({'base': {'id': 'appTest'}, 'webhook': {'id': 'achTest'}, 'timestamp': '2024-01-01T00:00:00.000Z'}).encode('utf-8')
+        response = await client.post('/integrations/airtable/webhooks', content=airtable_body, headers={'X-Airtable-Content-MAC': 'hmac-sha256=forged'})
+        assert response.status_code == 401
+        notion_body = json.dumps({'type': 'page.properties_updated', 'workspace_id': 'wsTest', 'entity': {'id': 'pageTest', 'type': 'page'}}).encode('utf-8')
+        response = await client.post('/integrations/notion/webhooks', content=notion_body, headers={'X-Notion-Signature': 'sha256=forged'})
+        assert response.status_code == 401
+        assert await apply_queued_events() == (0, 0)
+
+        print("\nTesting Signed Payloads...")
+        response = await client.post('/integrations/hubspot/webhooks', content=hubspot_body, headers={'X-HubSpot-Signature-v3': signature, 'X-HubSpot-Request-Timestamp': timestamp})
+        assert response.json() == {'received': 2}, response.text
+        response = await client.post('/integrations/airtable/webhooks', content=airtable_body, headers={'X-Airtable-Content-MAC': webhook_signature_airtable(airtable_body)})
+        assert response.json() == {'received': 1}, response.text
+        response = await client.post('/integrations/notion/webhooks', content=notion_body, headers={'X-Notion-Signature': webhook_signature_notion(notion_body)})
+        assert response.json() == {'received': 1}, response.text
+
+        print("\nTesting Applying Events...")
+        received, acknowledged = await apply_queued_events()
+        print(f"Applied {received} events")
+        assert received == acknowledged == 4
+        assert await search(client, 'hubspot', HUBSPOT_CREDENTIALS, 'updated7') == ['7']
+        assert await search(client, 'hubspot', HUBSPOT_CREDENTIALS, 'Deleted') == []
+        assert await search(client, 'airtable', AIRTABLE_CREDENTIALS, 'Changed') == ['recChanged']
+        assert await search(client, 'airtable', AIRTABLE_CREDENTIALS, 'Destroyed') == []
+        assert await search(client, 'notion', NOTION_CREDENTIALS, 'Renamed') == ['pageTest']
+        assert await get_value_redis('webhook_cursor:airtable:achTest') == '2'
+
+        print("\nTesting Retrying Unacknowledged Events...")
+        retried_body = json.dumps({'type': 'page.created', 'workspace_id': 'wsTest', 'entity': {'id': 'pageRetried', 'type': 'page'}}).encode('utf-8')
+        await client.post('/integrations/notion/webhooks', content=retried_body, headers={'X-Notion-Signature': webhook_signature_notion(retried_body)})
+        # Delivered to a worker that exits before acknowledging it
+        assert len(await read_stream_group_redis(webhooks.WEBHOOK_STREAM, webhooks.WEBHOOK_GROUP, 'worker-gone', webhooks.WEBHOOK_BATCH_SIZE)) == 1
+        webhooks.WEBHOOK_CLAIM_IDLE_MS = 0
+        webhooks.WEBHOOK_BLOCK_MS = 100
+        consumer = asyncio.create_task(webhooks._consume())
+        try:
+            for _ in range(50):
+                if len(await search(client, 'notion', NOTION_CREDENTIALS, 'Renamed')) == 2:
+                    break
+                await asyncio.sleep(0.1)
+        finally:
+            consumer.cancel()
+            await asyncio.gather(consumer, return_exceptions=True)
+        assert sorted(await search(client, 'notion', NOTION_CREDENTIALS, 'Renamed')) == ['pageRetried', 'pageTest']
+        # Claimed, applied and acknowledged: nothing is left pending
+        assert await claim_stream_entries_redis(webhooks.WEBHOOK_STREAM, webhooks.WEBHOOK_GROUP, webhooks.WEBHOOK_CONSUMER, 0, webhooks.WEBHOOK_BATCH_SIZE) == ('0-0', [])
+
+    await delete_key_redis(webhooks.WEBHOOK_STREAM)
+    print("\nWebhooks verified, queued and applied")
+
+if __name__ == "__main__":
+    asyncio.run(test_webhooks())
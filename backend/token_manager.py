@@ -0,0 +1,79 @@
+import asyncio
+import json
+import os
+import time
+import uuid
+
+from fastapi import HTTPException
+
+from rate_limiter import credential_key
+from redis_client import add_key_value_if_absent_redis, add_key_value_redis, delete_key_if_value_redis, get_value_redis
+
+# Tokens are refreshed once they are within this many seconds of expiring
+TOKEN_REFRESH_MARGIN = int(os.environ.get('TOKEN_REFRESH_MARGIN', 300))
+# Lock held by the one worker that talks to the token endpoint
+TOKEN_REFRESH_LOCK_TTL = int(os.environ.get('TOKEN_REFRESH_LOCK_TTL', 30))
+# How long other workers wait for that refresh to land before giving up; never
+# shorter than the lock, which a slow refresh (rate limited, retried) may hold throughout
+TOKEN_REFRESH_WAIT = max(float(os.environ.get('TOKEN_REFRESH_WAIT', TOKEN_REFRESH_LOCK_TTL)), TOKEN_REFRESH_LOCK_TTL)
+TOKEN_REFRESH_POLL_INTERVAL = 0.1
+
+_refreshes = {}
+
+def with_expiry(token_response: dict):
+    # Token endpoints return a relative `expires_in`; store the absolute time
+    credentials = dict(token_response)
+    if 'expires_in' in credentials:
+        credentials['expires_at'] = time.time() + int(credentials['expires_in'])
+    return credentials
+
+def needs_refresh(credentials: dict):
+    expires_at = credentials.get('expires_at')
+    return bool(credentials.get('refresh_token')) and expires_at is not None and expires_at - time.time() < TOKEN_REFRESH_MARGIN
+
+async def _wait_for_refresh(result_key: str):
+    deadline = time.monotonic() + TOKEN_REFRESH_WAIT
+    while time.monotonic() < deadline:
+        await asyncio.sleep(TOKEN_REFRESH_POLL_INTERVAL)
+        refreshed = await get_value_redis(result_key)
+        if refreshed:
+            return json.loads(refreshed)
+    raise HTTPException(status_code=504, detail='Timed out waiting for token refresh')
+
+async def _refresh(provider: str, fingerprint: str, credentials: dict, refresh_token):
+    result_key = f'{provider}_token_refresh:{fingerprint}'
+    lock_key = f'{provider}_token_refresh_lock:{fingerprint}'
+
+    # Another worker may already have refreshed this token
+    refreshed = await get_value_redis(result_key)
+    if refreshed and not needs_refresh(json.loads(refreshed)):
+        return json.loads(refreshed)
+
+    lock_id = uuid.uuid4().hex
+    if not await add_key_value_if_absent_redis(lock_key, lock_id, expire=TOKEN_REFRESH_LOCK_TTL):
+        return await _wait_for_refresh(result_key)
+    try:
+        refreshed = with_expiry(await refresh_token(credentials['refresh_token']))
+        # Providers may omit the refresh token when it is unchanged
+        refreshed.setdefault('refresh_token', credentials['refresh_token'])
+        ttl = int(refreshed.get('expires_at', time.time()) - time.time())
+        await add_key_value_redis(result_key, json.dumps(refreshed), expire=max(TOKEN_REFRESH_LOCK_TTL, ttl))
+        return refreshed
+    finally:
+        # A refresh that outlived the lock must not release another worker's
+        await delete_key_if_value_redis(lock_key, lock_id)
+
+async def ensure_fresh_credentials(provider: str, credentials: dict, refresh_token):
+    # Returns credentials that are valid for at least TOKEN_REFRESH_MARGIN seconds.
+    # `refresh_token(token)` calls the provider's token endpoint. Concurrent callers
+    # for the same credential share one refresh: in-process through a shared task,
+    # across workers through a Redis lock plus a published result.
+    if not needs_refresh(credentials):
+        return credentials
+
+    fingerprint = credential_key(credentials['refresh_token'])
+    task = _refreshes.get(fingerprint)
+    if task is None:
+        task = _refreshes[fingerprint] = asyncio.create_task(_refresh(provider, fingerprint, credentials, refresh_token))
+        task.add_done_callback(lambda _: _refreshes.pop(fingerprint, None))
+    return await asyncio.shield(task)
@@ -0,0 +1,169 @@
+import asyncio
+import time
+
+import httpx
+
+from http_clients import get_http_client
+from metrics import UPSTREAM_LATENCY, UPSTREAM_REQUESTS, profile_section
+from rate_limiter import RATE_LIMIT_MAX_RETRIES, acquire, backoff_seconds, block, credential_key, retry_after_seconds, try_acquire
+from request_policy import get_request_policy
+
+class UpstreamClient:
+    # Thin wrapper over the provider's pooled httpx client: every request takes a
+    # token from the shared per-provider/per-credential bucket and 429s are retried.
+    # Idempotent reads (GETs, and POSTs passed idempotent=True) also follow the
+    # provider's request policy: per-attempt deadlines, jittered retries on 5xx and
+    # connection errors, and a hedged duplicate for unusually slow attempts.
+    def __init__(self, provider: str, rate_key: str):
+        self.provider = provider
+        self.rate_key = rate_key
+
+    async def request(self, method: str, url: str, idempotent: bool = None, **kwargs):
+        client = get_http_client(self.provider)
+        if idempotent is None:
+            idempotent = method == 'GET'
+        policy = get_request_policy(self.provider) if idempotent else None
+        started_at = time.perf_counter()
+        # Time spent waiting on the rate limit is left out of the policy's call latency
+        rate_limit_seconds = 0.0
+        attempt = 0
+        retry = 0
+        while True:
+            wait_started_at = time.perf_counter()
+            with profile_section('rate_limit_wait'):
+                await acquire(self.provider, self.rate_key)
+            rate_limit_seconds += time.perf_counter() - wait_started_at
+
+            if policy is None:
+                response = await self._send(client, method, url, **kwargs)
+            else:
+                try:
+                    response = await self._attempt(client, policy, method, url, **kwargs)
+                except httpx.TransportError:
+                    if retry >= policy.max_retries:
+                        raise
+                    response = None
+                if (response is None or response.status_code >= 500) and retry < policy.max_retries:
+                    policy.record('retries')
+                    await asyncio.sleep(backoff_seconds(retry, policy.retry_backoff_base, policy.retry_backoff_max))
+                    retry += 1
+                    continue
+
+            if response.status_code == 429 and attempt < RATE_LIMIT_MAX_RETRIES:
+                delay = retry_after_seconds(response)
+                if delay is None:
+                    delay = backoff_seconds(attempt)
+                await block(self.provider, self.rate_key, delay)
+                await asyncio.sleep(delay)
+                rate_limit_seconds += delay
+                attempt += 1
+                continue
+
+            if policy is not None:
+                policy.record_call(method, time.perf_counter() - started_at - rate_limit_seconds)
+            return response
+
+    async def _attempt(self, client, policy, method: str, url: str, **kwargs):
+        # One attempt under the policy's deadline. If it is still running after the
+        # hedge delay and the rate budget has a token to spare right now, a duplicate
+        # is sent; the first usable response wins and the other request is cancelled.
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + policy.attempt_timeout
+        primary = asyncio.ensure_future(self._send(client, method, url, policy, **kwargs))
+        pending = {primary}
+        hedge = None
+        unusable = None
+        try:
+            hedge_delay = policy.hedge_delay()
+            if hedge_delay is not None:
+                done, _ = await asyncio.wait(pending, timeout=hedge_delay)
+                if not done:
+                    if await try_acquire(self.provider, self.rate_key):
+                        policy.record('hedges')
+                        hedge = asyncio.ensure_future(self._send(client, method, url, **kwargs))
+                        pending.add(hedge)
+                    else:
+                        policy.record('hedges_skipped')
+
+            while pending:
+                done, pending = await asyncio.wait(pending, timeout=max(0.0, deadline - loop.time()), return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    policy.record('timeouts')
+                    raise httpx.TimeoutException(f'No response from {self.provider} within {policy.attempt_timeout}s')
+                for task in done:
+                    if task.exception() is None and task.result().status_code < 500 and task.result().status_code != 429:
+                        if task is hedge:
+                            policy.record('hedges_won')
+                        return task.result()
+                    unusable = task
+            # Neither request got a usable response: surface the last error or status
+            return unusable.result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def _send(self, client, method: str, url: str, policy=None, **kwargs):
+        # With a policy, the attempt's latency feeds its hedge delay; abandoned
+        # attempts count with the time they had taken when they were cancelled
+        started_at = time.perf_counter()
+        status = 'error'
+        try:
+            with profile_section('network_wait'):
+                response = await client.request(method, url, **kwargs)
+            status = str(response.status_code)
+            return response
+        except asyncio.CancelledError:
+            status = 'cancelled'
+            raise
+        finally:
+            elapsed = time.perf_counter() - started_at
+            UPSTREAM_REQUESTS.labels(self.provider, method, status).inc()
+            UPSTREAM_LATENCY.labels(self.provider, method).observe(elapsed)
+            if policy is not None and status != 'error':
+                policy.attempt_latencies.add(elapsed)
+
+    async def get(self, url: str, **kwargs):
+        return await self.request('GET', url, **kwargs)
+
+    async def post(self, url: str, **kwargs):
+        return await self.request('POST', url, **kwargs)
+
+def upstream_client(provider: str, secret: str):
+    return UpstreamClient(provider, credential_key(secret))
+
+async def iter_pages_concurrently(page_iterators: list, max_concurrency: int):
+    # Runs up to `max_concurrency` page iterators at once and yields their pages
+    # as soon as each one arrives. `page_iterators` are zero-argument callables
+    # returning async iterators, so an iterator only starts once it holds a slot.
+    semaphore = asyncio.Semaphore(max_concurrency)
+    queue = asyncio.Queue(maxsize=max_concurrency * 2)
+    done = object()
+
+    async def produce(page_iterator):
+        async with semaphore:
+            async for page in page_iterator():
+                await queue.put(page)
+
+    async def produce_all(producers: list):
+        try:
+            await asyncio.gather(*producers)
+        finally:
+            await queue.put(done)
+
+    # One task per iterator so that all of them can be cancelled if any one fails
+    # or the consumer stops early; a sibling blocked on a full queue would otherwise leak
+    producers = [asyncio.create_task(produce(page_iterator)) for page_iterator in page_iterators]
+    waiter = asyncio.create_task(produce_all(producers))
+    try:
+        while True:
+            page = await queue.get()
+            if page is done:
+                break
+            yield page
+        # Surfaces any upstream error raised by a producer
+        await waiter
+    finally:
+        pending = [task for task in (*producers, waiter) if not task.done()]
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
@@ -0,0 +1,159 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import os
+import socket
+import time
+
+from fastapi import HTTPException, Request
+
+from item_store import apply_item_changes
+from providers import get_provider
+from redis_client import (
+    ack_stream_entries_redis,
+    add_key_value_redis,
+    add_key_values_redis,
+    add_stream_entries_redis,
+    claim_stream_entries_redis,
+    create_stream_group_redis,
+    get_values_redis,
+    read_stream_group_redis,
+)
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_STREAM = 'webhook_events'
+WEBHOOK_GROUP = 'webhook_appliers'
+# Entries kept in the stream; older ones are trimmed once applied or not
+WEBHOOK_STREAM_MAXLEN = int(os.environ.get('WEBHOOK_STREAM_MAXLEN', 100_000))
+# Events read and applied together; changes to the same object collapse into one
+WEBHOOK_BATCH_SIZE = int(os.environ.get('WEBHOOK_BATCH_SIZE', 500))
+WEBHOOK_BLOCK_MS = int(os.environ.get('WEBHOOK_BLOCK_MS', 1000))
+# How long a source (HubSpot portal, Airtable base, Notion workspace) stays mapped to its credentials
+WEBHOOK_SUBSCRIPTION_TTL = int(os.environ.get('WEBHOOK_SUBSCRIPTION_TTL', 30 * 24 * 3600))
+WEBHOOK_CONSUMER = os.environ.get('WEBHOOK_CONSUMER', f'{socket.gethostname()}:{os.getpid()}')
+# Entries unacknowledged this long, from a failed batch or from a consumer that has
+# since gone away (names change with every restart), are claimed and retried
+WEBHOOK_CLAIM_IDLE_MS = int(os.environ.get('WEBHOOK_CLAIM_IDLE_MS', 60_000))
+# Seconds between scans of the group's pending entries
+WEBHOOK_CLAIM_INTERVAL = float(os.environ.get('WEBHOOK_CLAIM_INTERVAL', 30))
+
+def sign_webhook_payload(secret: bytes, message: bytes, encoding: str = 'hex'):
+    # HMAC-SHA256 of `message`, hex or base64 encoded; providers verify with it and
+    # tests use it to produce locally signed payloads
+    digest = hmac.new(secret, message, hashlib.sha256).digest()
+    return digest.hex() if encoding == 'hex' else base64.b64encode(digest).decode('utf-8')
+
+def check_webhook_signature(expected: str, provided):
+    if not provided or not hmac.compare_digest(expected.encode('utf-8'), provided.encode('utf-8')):
+        raise HTTPException(status_code=401, detail='Invalid webhook signature')
+
+def _subscription_key(provider: str, source_id: str):
+    return f'webhook_subscription:{provider}:{source_id}'
+
+async def subscribe_webhooks(provider: str, source_id: str, credentials: str):
+    # Events from `source_id` are applied to the items stored for these credentials
+    get_provider(provider)
+    await add_key_value_redis(_subscription_key(provider, source_id), credentials, expire=WEBHOOK_SUBSCRIPTION_TTL)
+    return {'provider': provider, 'source_id': source_id}
+
+async def receive_webhook(provider: str, request: Request):
+    # Verifies the provider's signature, then queues the normalized events. Each
+    # event is a dict with source, action ('upsert', 'delete' or 'sync'),
+    # object_type and object_id; applying them happens in the consumer.
+    parse_webhook = get_provider(provider).handler('parse_webhook')
+    body = await request.body()
+    events = await parse_webhook(request, body)
+    await add_stream_entries_redis(
+        WEBHOOK_STREAM,
+        [{'provider': provider, 'event': json.dumps(event)} for event in events],
+        maxlen=WEBHOOK_STREAM_MAXLEN
+    )
+    return {'received': len(events)}
+
+def _collapse(entries: list):
+    # Groups events by provider and source, keeping the last action per object
+    groups = {}
+    for _, fields in entries:
+        try:
+            event = json.loads(fields['event'])
+            key = (fields['provider'], event['source'])
+        except (KeyError, ValueError):
+            logger.warning('Dropping malformed webhook event: %s', fields)
+            continue
+        groups.setdefault(key, {})[(event.get('object_type'), event.get('object_id'))] = event
+    return {key: list(events.values()) for key, events in groups.items()}
+
+async def _apply_group(provider: str, credentials: str, events: list):
+    # Provider handlers return the items to upsert, the `type:id` keys to delete and
+    # checkpoints (Redis key -> value, e.g. a payload cursor) that may only be saved
+    # once the changes are stored
+    apply_webhook_events = get_provider(provider).handler('apply_webhook_events')
+    items, deleted_keys, checkpoints = await apply_webhook_events(credentials, events)
+    await apply_item_changes(provider, credentials, items, deleted_keys)
+    if checkpoints:
+        await add_key_values_redis(checkpoints)
+    logger.info('Applied %d %s webhook events: %d upserted, %d deleted', len(events), provider, len(items), len(deleted_keys))
+
+async def apply_webhook_entries(entries: list):
+    # Applies one batch read from the stream; returns the ids that may be acknowledged.
+    # Events of a group that fails stay pending until a later scan claims them.
+    groups = _collapse(entries)
+    keys = list(groups)
+    subscriptions = dict(zip(keys, await get_values_redis([_subscription_key(provider, source) for provider, source in keys])))
+
+    failed = set()
+    for (provider, source), events in groups.items():
+        credentials = subscriptions[(provider, source)]
+        if not credentials:
+            logger.debug('No webhook subscription for %s source %s', provider, source)
+            continue
+        try:
+            await _apply_group(provider, credentials, events)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception('Applying %s webhook events for %s failed', provider, source)
+            failed.add((provider, source))
+
+    acknowledged = []
+    for entry_id, fields in entries:
+        try:
+            key = (fields['provider'], json.loads(fields['event'])['source'])
+        except (KeyError, ValueError):
+            key = None
+        if key not in failed:
+            acknowledged.append(entry_id)
+    return acknowledged
+
+async def _consume():
+    await create_stream_group_redis(WEBHOOK_STREAM, WEBHOOK_GROUP)
+    claim_start, next_claim_at = '0-0', 0.0
+    while True:
+        if time.monotonic() >= next_claim_at:
+            # Idle pending entries of any consumer first, a batch at a time, until
+            # the scan wraps around; then new entries until the next scan
+            claim_start, entries = await claim_stream_entries_redis(WEBHOOK_STREAM, WEBHOOK_GROUP, WEBHOOK_CONSUMER, WEBHOOK_CLAIM_IDLE_MS, WEBHOOK_BATCH_SIZE, claim_start)
+            if claim_start == '0-0':
+                next_claim_at = time.monotonic() + WEBHOOK_CLAIM_INTERVAL
+        else:
+            entries = await read_stream_group_redis(WEBHOOK_STREAM, WEBHOOK_GROUP, WEBHOOK_CONSUMER, WEBHOOK_BATCH_SIZE, WEBHOOK_BLOCK_MS)
+        if entries:
+            acknowledged = await apply_webhook_entries(entries)
+            await ack_stream_entries_redis(WEBHOOK_STREAM, WEBHOOK_GROUP, acknowledged)
+
+async def _run_consumer():
+    while True:
+        try:
+            await _consume()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning('Webhook consumer stopped: %s', getattr(e, 'detail', e))
+            await asyncio.sleep(1)
+
+def start_webhook_consumer():
+    return asyncio.create_task(_run_consumer())